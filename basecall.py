@@ -19,21 +19,43 @@ see <https://www.gnu.org/licenses/>.
 """
 
 import argparse
+import array
+import bisect
+import codecs
 import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import ctypes
+import ctypes.util
 import datetime
 import dateutil.parser
+import errno
+import fcntl
 import h5py
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import mmap
 import os
 import pathlib
-import random
+import pickle
+import queue
 import re
+import resource
+import shlex
 import shutil
-import statistics
+import socket
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import uuid
+import zlib
 
 
 BASECALLING = collections.OrderedDict([
@@ -58,32 +80,179 @@ BARCODING = collections.OrderedDict([
 ])
 
 
+# A fast5 which hasn't been modified for this long is assumed to be finished.
+FAST5_SETTLE_SECONDS = 30
+
+# The batch size used for the backlog in --catch_up mode.
+CATCH_UP_BATCH_SIZE = 100
+
+# How many batches can wait between pipeline stages (in --pipeline mode).
+PIPELINE_QUEUE_SIZE = 1
+
+# With --target_latency, batch sizes are chosen from a model fitted to this many recent batches,
+# and are never bigger than the maximum.
+BATCH_TIME_HISTORY = 20
+MAX_ADAPTIVE_BATCH_SIZE = 1000
+
+# How long to wait for the Guppy basecall server to load its model and start listening.
+SERVER_START_TIMEOUT = 300
+
+# The Linux ioctl request for cloning a file (used to stage fast5s as reflinks).
+FICLONE = 0x40049409
+
+# Buffer size for merging Guppy's output files when the kernel can't do the copy for us, and the
+# errors which mean the kernel copy isn't supported here.
+MERGE_BUFFER_SIZE = 16 * 1024 * 1024
+KERNEL_COPY_FALLBACK_ERRORS = {None, errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                               errno.EBADF, errno.ENOTSUP}
+
+# BGZF output (with --compress): the uncompressed size of each block (the same as bgzip uses),
+# how many compressed blocks can be waiting to be written, the compression level, the empty block
+# which marks the end of a BGZF file and the thread pool used for compression (created when first
+# needed). zlib releases the GIL, so the blocks really are compressed in parallel.
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_MAX_PENDING_BLOCKS = 256
+BGZF_COMPRESSION_LEVEL = 6
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+COMPRESSION_POOL = None
+
+# The resolution of the translocation speed (bp/s) and qscore sketches. Medians are accurate to
+# within half of these.
+SPEED_RESOLUTION = 0.01
+QSCORE_RESOLUTION = 0.01
+
+# The typed columns kept beside the merged sequencing summary (see SummaryColumns), with their
+# array type codes. The category columns hold codes into a list of values, i.e. they are
+# dictionary-encoded.
+SUMMARY_COLUMNS_DIR = 'sequencing_summary_columns'
+SUMMARY_COLUMN_TYPES = [('start_time', 'd'), ('duration', 'd'), ('sequence_length_template', 'I'),
+                        ('mean_qscore_template', 'f'), ('channel', 'H'), ('run_id', 'H'),
+                        ('barcode_arrangement', 'H')]
+SUMMARY_CATEGORY_COLUMNS = ['run_id', 'barcode_arrangement']
+
+# Read lengths below this are counted exactly when working out N50s. Longer ones are put in bins
+# 0.05% wide, of which there are enough to reach a few Mbp.
+EXACT_LENGTH_LIMIT = 65536
+LENGTH_BIN_RATIO = 0.0005
+LONG_LENGTH_BINS = 8192
+
+# The read ID index (see ReadIndex): its directory and the layout of each entry (read ID key,
+# fastq number, uncompressed offset and length of the fastq record).
+READ_INDEX_DIR = 'read_index'
+READ_INDEX_ENTRY = struct.Struct('<16sHQI')
+
+# Output files which are only ever appended to, so they can be truncated back to their size before
+# a merge if it was interrupted (see Ledger).
+APPEND_ONLY_OUTPUTS = ['sequencing_summary.txt', '*.fastq', '*.fastq.gz', '*.fastq.gz.gzi']
+
+# Subprocesses (i.e. Guppy) which are currently running, so they can be stopped on Ctrl-C.
+RUNNING_PROCESSES = set()
+
+# Guppy's output is relayed in chunks of up to this many bytes, and the figures parsed from it
+# are logged (one line per batch) to guppy_metrics.tsv in the output directory.
+RELAY_CHUNK_SIZE = 65536
+GUPPY_METRICS_COLUMNS = ['time', 'batch', 'fast5s', 'reads', 'samples', 'caller_seconds',
+                         'samples_per_second', 'elapsed_seconds', 'reads_per_second',
+                         'progress_percent']
+GUPPY_METRICS_LOCK = threading.Lock()
+
+# The stages of each batch which are timed (see StageMetrics), the prefix of the Prometheus metrics
+# and the stages which are run under cProfile with --profile.
+STAGES = ['discover', 'record_run_start', 'stage', 'basecall', 'merge', 'summary_update',
+          'summary_report']
+PROMETHEUS_PREFIX = 'minion_basecall'
+PROFILED_STAGES = {'summary_update', 'summary_report'}
+
+# Even when inotify is available, rescan the input directory this often in case we missed
+# something (e.g. on a network filesystem).
+FULL_RESCAN_SECONDS = 300
+
+
 def get_arguments():
     parser = MyParser(description='Basecall reads in real-time with Guppy',
                       formatter_class=MyHelpFormatter, add_help=False)
 
     required = parser.add_argument_group('Required')
-    required.add_argument('-i', '--in_dir', type=pathlib.Path, required=True,
-                          help='Input directory (will be searched recursively for fast5s)')
-    required.add_argument('-o', '--out_dir', type=pathlib.Path, required=True,
-                          help='Output directory')
     required.add_argument('--barcodes', type=str, required=True,
                           help='Which barcodes to use ({})'.format(join_with_or(BARCODING)))
     required.add_argument('--model', type=str, required=True,
                           help='Which basecalling model to use '
                                '({})'.format(join_with_or(BASECALLING)))
 
+    positions = parser.add_argument_group('Input and output (-i and -o, or --position/--positions)')
+    positions.add_argument('-i', '--in_dir', type=pathlib.Path, required=False,
+                           help='Input directory (will be searched recursively for fast5s)')
+    positions.add_argument('-o', '--out_dir', type=pathlib.Path, required=False,
+                           help='Output directory')
+    positions.add_argument('--position', type=pathlib.Path, nargs=2, action='append',
+                           metavar=('IN_DIR', 'OUT_DIR'),
+                           help='An input and output directory for one flow cell (can be used '
+                                'more than once)')
+    positions.add_argument('--positions', type=pathlib.Path, required=False,
+                           help='A file of input and output directories, one tab-separated pair '
+                                'per line')
+
     options = parser.add_argument_group('Options')
     options.add_argument('--batch_size', type=int, required=False, default=10,
-                         help='Number of fast5 files to basecall per batch')
+                         help='Number of fast5 files to basecall per batch (the first batch with '
+                              '--target_latency)')
+    options.add_argument('--target_latency', type=int, required=False,
+                         help='Choose batch sizes adaptively, aiming to merge each fast5 within '
+                              'this many minutes of it being found (default: fixed batches of '
+                              '--batch_size)')
+    options.add_argument('--catch_up', action='store_true',
+                         help='Basecall fast5s which are already waiting at start-up (e.g. after '
+                              'a restart) in large batches, with the summaries put off until '
+                              'they are done, then switch to normal batches')
+    options.add_argument('--catch_up_batch_size', type=int, required=False,
+                         default=CATCH_UP_BATCH_SIZE,
+                         help='Number of fast5 files per batch when catching up')
+    options.add_argument('--catch_up_priority', type=str, required=False, default='oldest',
+                         choices=['oldest', 'newest'],
+                         help='When catching up, whether to finish the backlog first (oldest) or '
+                              'to basecall and report new fast5s first (newest)')
     options.add_argument('--stop_time', type=int, required=False, default=60,
                          help="Automatically stop when a new fast5 file hasn't been seen for this "
                               "many minutes")
     options.add_argument('--cpu', action='store_true',
                          help='Use the CPU for basecalling (default: use the GPU)')
+    options.add_argument('--pipeline', action='store_true',
+                         help='Stage the next batch and merge the previous batch while the '
+                              'current batch is being basecalled')
+    options.add_argument('--workers', type=int, required=False, default=1,
+                         help='Number of Guppy basecallers to run at once, each with its share of '
+                              'the CPU threads (requires --cpu, implies --pipeline)')
+    options.add_argument('--basecaller_command', type=str, required=False,
+                         default='guppy_basecaller',
+                         help='Command used to run the basecaller for each batch')
+    options.add_argument('--server', action='store_true',
+                         help='Start one Guppy basecall server for the whole run (so the model is '
+                              'only loaded once) and send each batch to it')
+    options.add_argument('--server_command', type=str, required=False,
+                         default='guppy_basecall_server',
+                         help='Command used to start the basecall server (with --server)')
+    options.add_argument('--temp_dir', type=pathlib.Path, required=False,
+                         help='Scratch directory for staged fast5s, e.g. a tmpfs (default: the '
+                              'system temp directory)')
+    options.add_argument('--compress', action='store_true',
+                         help='Write reads to BGZF-compressed fastq.gz files (with a .gzi block '
+                              'index) instead of plain fastq files')
+    options.add_argument('--min_qscore', type=float, required=False,
+                         help='Reads with a lower mean qscore go to the *_fail.fastq files')
+    options.add_argument('--min_length', type=int, required=False,
+                         help='Reads shorter than this go to the *_fail.fastq files')
+    options.add_argument('--no_read_index', action='store_true',
+                         help="Don't keep an index of where each read is in the fastqs (used by "
+                              "'basecall.py lookup')")
     options.add_argument('--trans_window', type=int, required=False, default=60,
                          help='The time window size (in minutes) for the translocation speed '
                               'summary')
+    options.add_argument('--summary_interval', type=int, required=False, default=30,
+                         help='Refresh the summaries (in the background) at most this often, in '
+                              'seconds')
+    options.add_argument('--profile', action='store_true',
+                         help='Run the summary functions under cProfile and save the stats to '
+                              'summary_profile.pstats in the output directory')
     options.add_argument('-h', '--help', action='help',
                          help='Show this help message and exit')
 
@@ -94,33 +263,106 @@ def get_arguments():
 
 def main():
     check_python_version()
+    if len(sys.argv) > 1 and sys.argv[1] == 'lookup':
+        lookup_reads(get_lookup_arguments(sys.argv[2:]))
+        return
     args = get_arguments()
     check_guppy_version()
-    make_output_directory(args.out_dir)
+    positions = [Position(in_dir, out_dir, args) for in_dir, out_dir in args.positions]
+    scheduler = FairScheduler(positions, args)
+    summary_worker = SummaryWorker(args)
+
+    server = BasecallServer(args.server_command, args.model, args.cpu, args.out_dir) \
+        if args.server else None
+    pipeline = Pipeline(args, summary_worker, server) if args.pipeline else None
 
     try:
+        if server is not None:
+            server.start()
         minutes_since_last_read, waiting = 0.0, False
         while True:
             if minutes_since_last_read >= args.stop_time:
                 print_stop_message(args.stop_time)
                 break
 
-            new_fast5s, all_fast5s = check_for_reads(args.batch_size, args.in_dir, args.out_dir)
+            position, new_fast5s, all_fast5s, catch_up = scheduler.next_batch()
             if new_fast5s:
-                basecall_reads(new_fast5s, args.barcodes, args.model, args.cpu, args.out_dir)
-                summary_info(args.out_dir, args.barcodes, all_fast5s, args.trans_window)
+                with position.metrics.measure('record_run_start') as stage:
+                    position.run_start_times.record(new_fast5s)
+                    stage.items = len(new_fast5s)
+                if pipeline is not None:
+                    pipeline.submit(position, new_fast5s, all_fast5s, catch_up)
+                else:
+                    start_time = time.time()
+                    basecall_reads(new_fast5s, position.ledger, args.basecaller_command,
+                                   args.barcodes, args.model, args.cpu, server, args.temp_dir,
+                                   args.compress, position.metrics, not args.no_read_index,
+                                   args.read_filter)
+                    if position.batch_sizer is not None:
+                        position.batch_sizer.observe(len(new_fast5s), time.time() - start_time)
+                    if position.wants_summary(catch_up):
+                        summary_worker.request(position, all_fast5s)
                 minutes_since_last_read, waiting = 0.0, False
 
             else:  # no new reads
-                print_waiting_message(waiting)
-                waiting = True
+                if pipeline is None or pipeline.is_idle():
+                    print_waiting_message(waiting)
+                    waiting = True
                 tick_seconds = 10
                 minutes_since_last_read += tick_seconds / 60
-                time.sleep(tick_seconds)
+                sleep_and_check(tick_seconds, pipeline)
+
+        if pipeline is not None:
+            pipeline.finish()
+        summary_worker.close()
 
     except KeyboardInterrupt:
+        if server is not None:
+            server.stop()
+        if pipeline is not None:
+            pipeline.shutdown()
+        terminate_running_processes()
+        summary_worker.close()
         print()
 
+    except BasecallServerError as e:
+        if pipeline is not None:
+            pipeline.shutdown()
+        terminate_running_processes()
+        sys.exit('Error: {}'.format(e))
+
+    finally:
+        if server is not None:
+            server.stop()
+
+
+def get_position_directories(args):
+    """
+    Returns the (input directory, output directory) pairs to basecall, from -i/-o, --position and
+    --positions (in that order).
+    """
+    if (args.in_dir is None) != (args.out_dir is None):
+        sys.exit('Error: -i/--in_dir and -o/--out_dir must be used together')
+    positions = []
+    if args.in_dir is not None:
+        positions.append((args.in_dir, args.out_dir))
+    if args.position:
+        positions += [(in_dir, out_dir) for in_dir, out_dir in args.position]
+    if args.positions is not None:
+        if not args.positions.is_file():
+            sys.exit('Error: {} is not a file'.format(args.positions))
+        with open(str(args.positions), 'rt') as positions_file:
+            for line in positions_file:
+                line = line.rstrip('\n')
+                if not line.strip() or line.startswith('#'):
+                    continue
+                parts = line.split('\t')
+                if len(parts) != 2:
+                    sys.exit('Error: each line of {} must be an input directory and an output '
+                             'directory, separated by a tab'.format(args.positions))
+                positions.append((pathlib.Path(parts[0]), pathlib.Path(parts[1])))
+    return positions
+
 
 def check_arguments(args):
     barcode_choices = list(BARCODING.keys())
@@ -133,8 +375,20 @@ def check_arguments(args):
     if args.model not in model_choices:
         sys.exit('Error: valid --model choices are: {}'.format(join_with_or(model_choices)))
 
-    if not args.in_dir.is_dir():
-        sys.exit('Error: {} is not a directory'.format(args.in_dir))
+    args.positions = get_position_directories(args)
+    if not args.positions:
+        sys.exit('Error: either -i/--in_dir and -o/--out_dir or --position is required')
+    for in_dir, out_dir in args.positions:
+        if not in_dir.is_dir():
+            sys.exit('Error: {} is not a directory'.format(in_dir))
+        if out_dir.is_file():
+            sys.exit('Error: {} is a file (must be a directory)'.format(out_dir))
+    out_dirs = [out_dir.resolve() for _, out_dir in args.positions]
+    if len(set(out_dirs)) < len(out_dirs):
+        sys.exit('Error: each position needs its own output directory')
+
+    # The shared basecaller's files (e.g. the server log) go in the first position's directory.
+    args.in_dir, args.out_dir = args.positions[0]
 
     if args.stop_time <= 0:
         sys.exit('Error: --stop_time must be a positive integer')
@@ -142,18 +396,636 @@ def check_arguments(args):
     if args.batch_size <= 0:
         sys.exit('Error: --batch_size must be a positive integer')
 
-    if args.out_dir.is_file():
-        sys.exit('Error: {} is a file (must be a directory)'.format(args.out_dir))
+    if args.catch_up_batch_size <= 0:
+        sys.exit('Error: --catch_up_batch_size must be a positive integer')
+
+    if args.target_latency is not None and args.target_latency <= 0:
+        sys.exit('Error: --target_latency must be a positive integer')
+
+    if args.summary_interval < 0:
+        sys.exit('Error: --summary_interval cannot be negative')
+
+    if args.min_length is not None and args.min_length < 0:
+        sys.exit('Error: --min_length cannot be negative')
+    args.read_filter = ReadFilter(args.min_qscore, args.min_length) \
+        if args.min_qscore is not None or args.min_length is not None else None
+
+    if args.temp_dir is not None and not args.temp_dir.is_dir():
+        sys.exit('Error: {} is not a directory'.format(args.temp_dir))
+
+    if args.workers <= 0:
+        sys.exit('Error: --workers must be a positive integer')
+    if args.workers > 1:
+        if not args.cpu:
+            sys.exit('Error: --workers can only be used with --cpu')
+        if args.server:
+            sys.exit('Error: --workers cannot be used with --server')
+        args.pipeline = True
+
+
+def get_lookup_arguments(argv):
+    parser = MyParser(prog='basecall.py lookup',
+                      description='Extract reads by ID from the fastqs made by basecall.py, using '
+                                  'its read index',
+                      formatter_class=MyHelpFormatter, add_help=False)
+    required = parser.add_argument_group('Required')
+    required.add_argument('-o', '--out_dir', type=pathlib.Path, required=True,
+                          help='Output directory of basecall.py')
+
+    options = parser.add_argument_group('Options')
+    options.add_argument('read_ids', type=str, nargs='*',
+                         help='Read IDs to extract')
+    options.add_argument('--read_ids', type=pathlib.Path, required=False, dest='read_id_file',
+                         help='File of read IDs, one per line or in a read_id column (e.g. a '
+                              'sequencing summary)')
+    options.add_argument('-h', '--help', action='help',
+                         help='Show this help message and exit')
+    args = parser.parse_args(argv)
+    if not (args.out_dir / READ_INDEX_DIR).is_dir():
+        sys.exit('Error: {} has no read index'.format(args.out_dir))
+    if args.read_id_file is not None and not args.read_id_file.is_file():
+        sys.exit('Error: {} is not a file'.format(args.read_id_file))
+    if not args.read_ids and args.read_id_file is None:
+        sys.exit('Error: no read IDs given')
+    return args
+
+
+def lookup_reads(args):
+    """
+    Writes the fastq records of the given reads to stdout, in the order they're found in the
+    fastqs (which keeps the reading sequential). Reads which aren't in the index are listed on
+    stderr.
+    """
+    read_ids = list(args.read_ids)
+    if args.read_id_file is not None:
+        read_ids += load_read_ids(args.read_id_file)
+    index = ReadIndex(args.out_dir)
+    locations = index.find(set(read_ids))
+    missing = set(read_ids)
+    output = sys.stdout.buffer
+    by_file = collections.defaultdict(list)
+    for read_id, (file_number, offset, length) in locations.items():
+        by_file[file_number].append((offset, length, read_id))
+    for file_number, reads in sorted(by_file.items()):
+        with FastqReader(str(args.out_dir / index.manifest['files'][file_number])) as fastq:
+            for offset, length, read_id in sorted(reads):
+                record = fastq.read(offset, length)
+                if get_fastq_read_id(record) != read_id:  # a hash collision or a stale index
+                    continue
+                output.write(record)
+                missing.discard(read_id)
+    output.flush()
+    if missing:
+        print('{:,} read{} not found:'.format(len(missing), '' if len(missing) == 1 else 's'),
+              file=sys.stderr)
+        for read_id in sorted(missing):
+            print('    {}'.format(read_id), file=sys.stderr)
+
+
+def load_read_ids(filename):
+    """
+    Loads read IDs from a file which either has one per line or is tab-delimited with a read_id
+    column in its header (e.g. sequencing_summary.txt).
+    """
+    read_ids = []
+    with open(str(filename), 'rt') as read_id_file:
+        column = None
+        for i, line in enumerate(read_id_file):
+            parts = line.rstrip('\n').split('\t')
+            if i == 0 and 'read_id' in parts:
+                column = parts.index('read_id')
+                continue
+            read_id = parts[column] if column is not None and column < len(parts) else parts[0]
+            if read_id.strip():
+                read_ids.append(read_id.strip())
+    return read_ids
+
+
+class Position(object):
+    """
+    One flow cell's input and output directories, along with everything which is kept separately
+    for each flow cell: its ledger, fast5 discovery, summaries, batch sizer and metrics.
+    """
+    def __init__(self, in_dir, out_dir, args):
+        self.name = str(out_dir)
+        self.in_dir, self.out_dir = in_dir, out_dir
+        make_output_directory(out_dir)
+        self.ledger = Ledger(in_dir, out_dir)
+        self.ledger.recover()
+        update_summary_columns(out_dir)
+        self.summary = SummaryAggregator(out_dir, args.read_filter)
+        self.run_start_times = RunStartTimes(out_dir)
+        self.discovery = Fast5Discovery(in_dir, self.ledger)
+        self.batch_sizer = BatchSizer(args.target_latency, args.batch_size, args.workers,
+                                      out_dir) if args.target_latency is not None else None
+        self.metrics = StageMetrics(out_dir, args.profile,
+                                    self.name if len(args.positions) > 1 else None)
+        self.last_batch_time = 0.0
+        self.catch_up_batches = 0  # backlog batches which have been taken but not yet merged
+        self.lock = threading.Lock()  # batches are taken and merged in different threads
+        if args.catch_up:
+            self.discovery.start_catch_up()
+
+    def take_catch_up_batch(self, batch_size, newest_first):
+        with self.lock:
+            self.catch_up_batches += 1
+        return self.discovery.next_backlog_batch(batch_size, newest_first)
+
+    def wants_summary(self, catch_up):
+        """
+        This is called as each batch is merged. The summaries are put off while catching up, until
+        every backlog batch has been merged (in --pipeline mode, some can still be in flight after
+        the last one is taken).
+        """
+        if not catch_up:
+            return True
+        with self.lock:
+            self.catch_up_batches -= 1
+            return self.catch_up_batches == 0 and not self.discovery.backlog
+
+
+class FairScheduler(object):
+    """
+    This class decides which position's fast5s are basecalled next, when several flow cells share
+    one basecaller. It picks the position which has been waiting longest, counting from when its
+    oldest pending fast5 was found or from when it last had a batch, whichever is later. So when
+    every position has a backlog they take turns, and otherwise the oldest fast5s go first, which
+    stops one flow cell's latency falling behind the others'. With one position, it just takes
+    that position's next batch.
+
+    In --catch_up mode, a position's backlog is taken in large batches. With the oldest-first
+    priority the backlog goes before any new fast5s, and with newest-first new fast5s go first
+    (in normal batches) so they're reported without waiting for the backlog.
+    """
+    def __init__(self, positions, args):
+        self.positions = positions
+        self.batch_size = args.batch_size
+        self.catch_up_batch_size = args.catch_up_batch_size
+        self.newest_first = args.catch_up_priority == 'newest'
+        for position in positions:
+            if position.discovery.backlog:
+                print('Catching up on {:,} fast5s in {} in batches of {} ({} first)'.format(
+                    len(position.discovery.backlog), position.in_dir, self.catch_up_batch_size,
+                    args.catch_up_priority))
+
+    def next_batch(self):
+        """
+        Looks for new fast5s in every position and returns the chosen position with its next batch,
+        all of its fast5s and whether the batch is from its catch-up backlog. If nothing is
+        waiting, there's no position and the batch is empty.
+        """
+        for position in self.positions:
+            discovery = position.discovery
+            with position.metrics.measure('discover') as stage:
+                pending = len(discovery.pending)
+                discovery.poll()
+                stage.items = len(discovery.pending) - pending
+                stage.discard = stage.items == 0  # idle polls aren't worth recording
+            position.metrics.set_backlog(len(discovery.pending))
+        waiting = [p for p in self.positions if p.discovery.pending or p.discovery.backlog]
+        if not waiting:
+            return None, [], [], False
+        now = time.time()
+        position = min(waiting, key=lambda p: max(now - p.discovery.oldest_wait(),
+                                                   p.last_batch_time))
+        position.last_batch_time = now
+        if len(self.positions) > 1:
+            print('\nNext batch from {}'.format(position.name))
+        discovery = position.discovery
+        catch_up = bool(discovery.backlog) and not (self.newest_first and discovery.pending)
+        if catch_up:
+            new_fast5s = position.take_catch_up_batch(self.catch_up_batch_size, self.newest_first)
+            if not discovery.backlog:
+                print('\nCaught up on {}, switching to normal batches'.format(position.in_dir))
+        else:
+            new_fast5s = take_batch(discovery, self.batch_size, position.batch_sizer)
+        return position, new_fast5s, discovery.all_fast5s(), catch_up
+
+
+def check_for_reads(discovery, batch_size, batch_sizer=None):
+    discovery.poll()
+    return take_batch(discovery, batch_size, batch_sizer), discovery.all_fast5s()
+
 
+def take_batch(discovery, batch_size, batch_sizer=None):
+    if batch_sizer is not None and discovery.pending:
+        batch_size = batch_sizer.choose(len(discovery.pending), discovery.oldest_wait())
+    return discovery.next_batch(batch_size)
 
-def check_for_reads(batch_size, in_dir, out_dir):
-    all_fast5_files = [x.resolve() for x in in_dir.glob('**/*.fast5')]
-    already_basecalled = load_already_basecalled(out_dir)
-    new_fast5_files = [f for f in all_fast5_files if f.name not in already_basecalled]
-    return sorted(f for f in new_fast5_files)[:batch_size], all_fast5_files
+
+class BatchSizer(object):
+    """
+    This class picks batch sizes for --target_latency. The time to basecall a batch of n fast5s
+    is modelled as overhead + n * per_fast5 (Guppy starting up and loading the model vs the
+    basecalling itself), fitted by least squares to recent batches. The next batch is the
+    smallest one which still gets the whole backlog merged within the target latency (counting
+    from when the oldest waiting fast5 was found), so batches grow when there's a backlog and
+    shrink when we've caught up. When the target can't be met, batches are as big as allowed,
+    which gives the most throughput.
+
+    Each decision and each observed batch time is logged to batch_sizing.tsv in the output
+    directory, for tuning the target.
+    """
+    LOG_HEADER = ['time', 'event', 'batch_size', 'backlog', 'oldest_wait_seconds',
+                  'overhead_seconds', 'seconds_per_fast5', 'predicted_seconds', 'observed_seconds']
+
+    def __init__(self, target_minutes, initial_size, workers, out_dir):
+        self.target_seconds = target_minutes * 60
+        self.initial_size = initial_size
+        self.workers = workers
+        self.filename = out_dir / 'batch_sizing.tsv'
+        self.history = collections.deque(maxlen=BATCH_TIME_HISTORY)
+        self.lock = threading.Lock()
+
+    def fit(self):
+        """
+        Returns (overhead, per_fast5) seconds, or None if no batches have finished yet. Until
+        batches of at least two different sizes have been seen, all of the time is attributed to
+        the fast5s, which makes small batches look cheap and so gets a second size tried.
+        """
+        with self.lock:
+            points = list(self.history)
+        if not points:
+            return None
+        sizes = [n for n, _ in points]
+        times = [t for _, t in points]
+        if len(set(sizes)) < 2:
+            return 0.0, sum(times) / sum(sizes)
+        mean_size, mean_time = sum(sizes) / len(sizes), sum(times) / len(times)
+        covariance = sum((n - mean_size) * (t - mean_time) for n, t in points)
+        variance = sum((n - mean_size) ** 2 for n in sizes)
+        per_fast5 = covariance / variance
+        overhead = mean_time - per_fast5 * mean_size
+        if per_fast5 < 0.0:
+            return mean_time, 0.0
+        if overhead < 0.0:
+            return 0.0, sum(n * t for n, t in points) / sum(n * n for n in sizes)
+        return overhead, per_fast5
+
+    def choose(self, backlog, oldest_wait):
+        model = self.fit()
+        if model is None:
+            size = min(self.initial_size, backlog)
+            self.log('chosen', size, backlog, oldest_wait)
+            return size
+        overhead, per_fast5 = model
+        budget = self.target_seconds - oldest_wait
+        largest = min(backlog, MAX_ADAPTIVE_BATCH_SIZE)
+        size = largest
+        for n in range(1, largest + 1):
+            rounds = math.ceil(math.ceil(backlog / n) / self.workers)
+            if rounds * (overhead + per_fast5 * n) <= budget:
+                size = n
+                break
+        predicted = overhead + per_fast5 * size
+        self.log('chosen', size, backlog, oldest_wait, overhead, per_fast5, predicted)
+        print('\nBatch size: {:,} (backlog of {:,} fast5s, predicted {:.0f} s per '
+              'batch)'.format(size, backlog, predicted))
+        return size
+
+    def observe(self, size, seconds):
+        with self.lock:
+            self.history.append((size, seconds))
+        self.log('finished', size, observed=seconds)
+
+    def log(self, event, size, backlog=None, oldest_wait=None, overhead=None, per_fast5=None,
+            predicted=None, observed=None):
+        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        values = [timestamp, event, str(size), format_optional(backlog, '{}'),
+                  format_optional(oldest_wait, '{:.1f}'), format_optional(overhead, '{:.2f}'),
+                  format_optional(per_fast5, '{:.3f}'), format_optional(predicted, '{:.1f}'),
+                  format_optional(observed, '{:.1f}')]
+        with self.lock:
+            new_file = not self.filename.is_file()
+            with open(str(self.filename), 'at') as log:
+                if new_file:
+                    log.write('\t'.join(self.LOG_HEADER) + '\n')
+                log.write('\t'.join(values) + '\n')
+
+
+class Fast5Discovery(object):
+    """
+    This class keeps an in-memory index of the fast5s in the input directory, so we don't need to
+    glob the whole directory on every tick. New files arrive via inotify where it's available,
+    and an incremental rescan (which only lists directories whose mtime has changed) is used as a
+    fallback. Files are held back until they look complete, i.e. MinKNOW has moved them into
+    place or hasn't touched them for FAST5_SETTLE_SECONDS.
+    """
+    def __init__(self, in_dir, ledger):
+        self.in_dir = in_dir
+        self.ledger = ledger
+        self.seen = set()
+        self.incomplete = set()
+        self.pending = []  # heap of fast5s ready to basecall
+        self.backlog = []  # fast5s which were waiting at start-up, oldest first (with --catch_up)
+        self.found_times = {}  # when each pending fast5 became ready
+        self.dir_mtimes = {}
+        self.subdirs = {}  # directory -> its subdirectories, as of its mtime in dir_mtimes
+        self.last_rescan = 0.0
+        self.inotify = Inotify.create()
+        if self.inotify is not None:
+            self.inotify.add_watch(in_dir)
+        self.rescan()
+
+    def poll(self):
+        if self.inotify is None or time.time() - self.last_rescan >= FULL_RESCAN_SECONDS:
+            self.rescan()
+        else:
+            self.read_events()
+        self.check_incomplete()
+
+    def next_batch(self, batch_size):
+        batch = []
+        while self.pending and len(batch) < batch_size:
+            fast5 = heapq.heappop(self.pending)
+            self.found_times.pop(fast5, None)
+            batch.append(fast5)
+        return batch
+
+    def start_catch_up(self):
+        """
+        Moves the fast5s which are waiting now into the backlog, sorted by modification time.
+        """
+        self.backlog = sorted(self.pending, key=lambda f: (get_mtime(f), f))
+        self.pending = []
+
+    def next_backlog_batch(self, batch_size, newest_first=False):
+        if newest_first:
+            batch = self.backlog[-batch_size:][::-1]
+            del self.backlog[-batch_size:]
+        else:
+            batch = self.backlog[:batch_size]
+            del self.backlog[:batch_size]
+        for fast5 in batch:
+            self.found_times.pop(fast5, None)
+        return batch
+
+    def oldest_wait(self):
+        """
+        Returns how many seconds the longest-waiting fast5 has been ready for.
+        """
+        if not self.found_times:
+            return 0.0
+        return time.time() - min(self.found_times.values())
+
+    def all_fast5s(self):
+        return list(self.seen)
+
+    def rescan(self):
+        """
+        Walks the directory tree, but only lists directories which have changed since the last
+        rescan. Unchanged ones are just stat-ed, and their subdirectories come from the cache.
+        """
+        self.last_rescan = time.time()
+        directories = [str(self.in_dir)]
+        while directories:
+            directory = directories.pop()
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+                if self.dir_mtimes.get(directory) == mtime and directory in self.subdirs:
+                    directories.extend(self.subdirs[directory])
+                    continue
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            self.dir_mtimes[directory] = mtime
+            self.subdirs[directory] = []
+            for entry in entries:
+                if entry.is_dir():
+                    if self.inotify is not None and entry.path not in self.dir_mtimes:
+                        self.inotify.add_watch(entry.path)
+                    self.subdirs[directory].append(entry.path)
+                    directories.append(entry.path)
+                elif entry.name.endswith('.fast5'):
+                    self.add(pathlib.Path(entry.path), moved_in=False)
+
+    def read_events(self):
+        events = self.inotify.read_events()
+        if events is None:  # the event queue overflowed, so we may have missed files
+            self.rescan()
+            return
+        for path, mask in events:
+            if mask & Inotify.IN_ISDIR:
+                self.inotify.add_watch(path)
+                self.dir_mtimes.pop(str(path), None)
+                self.rescan()
+            elif path.name.endswith('.fast5'):
+                self.add(path, moved_in=bool(mask & Inotify.IN_MOVED_TO))
+
+    def add(self, fast5, moved_in):
+        if fast5 in self.seen or fast5 in self.incomplete:
+            return
+        if moved_in or is_fast5_complete(fast5):
+            self.incomplete.discard(fast5)
+            self.seen.add(fast5)
+            if not self.ledger.is_basecalled(fast5):
+                resolved = fast5.resolve()
+                heapq.heappush(self.pending, resolved)
+                self.found_times[resolved] = time.time()
+        else:
+            self.incomplete.add(fast5)
+
+    def check_incomplete(self):
+        for fast5 in [f for f in self.incomplete if is_fast5_complete(f)]:
+            self.incomplete.discard(fast5)
+            self.add(fast5, moved_in=True)
+
+
+def get_mtime(path):
+    try:
+        return path.stat().st_mtime
+    except OSError:
+        return 0.0
 
 
-def load_already_basecalled(out_dir):
+def is_fast5_complete(fast5):
+    """
+    MinKNOW keeps writing to a fast5 until it's full, so a file whose mtime is recent may still
+    be growing.
+    """
+    try:
+        return time.time() - fast5.stat().st_mtime >= FAST5_SETTLE_SECONDS
+    except OSError:
+        return False
+
+
+class Inotify(object):
+    """
+    A minimal ctypes wrapper around Linux's inotify, used to hear about new fast5s without
+    rescanning the input directory.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = os.O_NONBLOCK
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, libc, fd):
+        self.libc = libc
+        self.fd = fd
+        self.watches = {}
+
+    @classmethod
+    def create(cls):
+        """
+        Returns an Inotify object, or None if inotify isn't available on this system.
+        """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(cls.IN_NONBLOCK)
+        except (OSError, AttributeError, TypeError):
+            return None
+        if fd < 0:
+            return None
+        return cls(libc, fd)
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, str(directory).encode(), self.WATCH_MASK)
+        if wd >= 0:
+            self.watches[wd] = pathlib.Path(directory)
+
+    def read_events(self):
+        """
+        Returns a list of (path, mask) for all waiting events, or None if events were lost.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            i = 0
+            while i < len(data):
+                wd, mask, _, name_len = self.EVENT_HEADER.unpack_from(data, i)
+                i += self.EVENT_HEADER.size
+                name = data[i:i + name_len].rstrip(b'\0').decode()
+                i += name_len
+                if mask & self.IN_Q_OVERFLOW:
+                    return None
+                if wd in self.watches and name:
+                    events.append((self.watches[wd] / name, mask))
+
+
+class Ledger(object):
+    """
+    This class records which fast5s have been basecalled. It's kept in memory as a set and on
+    disk as a journal (basecall_journal.jsonl in the output directory) which is only read at
+    startup. Fast5s are identified by their path relative to the input directory, their size and
+    their mtime, so files with the same name in different directories don't collide.
+
+    Merging a batch into the output files is bracketed by 'begin' and 'commit' records. The begin
+    record holds the sizes of the append-only output files beforehand, and Guppy's output for the
+    batch stays in the output directory until the commit. So if we're killed part way through a
+    merge, the next run truncates the outputs back to the recorded sizes and merges the batch
+    again, without basecalling it again.
+    """
+    def __init__(self, in_dir, out_dir):
+        self.in_dir = os.path.realpath(str(in_dir))
+        self.out_dir = out_dir
+        self.filename = out_dir / 'basecall_journal.jsonl'
+        self.batch_dir = out_dir / 'batches_in_progress'
+        self.basecalled = set()
+        self.legacy_names = load_legacy_basecalled_filenames(out_dir)
+        self.incomplete = None
+        if self.filename.is_file():
+            with open(str(self.filename), 'rt') as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:  # a partly written last line
+                        continue
+                    if 'begin' in record:
+                        self.incomplete = record
+                    elif 'commit' in record and self.incomplete is not None:
+                        self.basecalled.update(tuple(k) for k in self.incomplete['fast5s'])
+                        self.incomplete = None
+
+    def key(self, fast5):
+        stat = os.stat(str(fast5))
+        path = os.path.relpath(os.path.realpath(str(fast5)), self.in_dir)
+        return path, stat.st_size, stat.st_mtime_ns
+
+    def is_basecalled(self, fast5):
+        if fast5.name in self.legacy_names:
+            return True
+        try:
+            return self.key(fast5) in self.basecalled
+        except OSError:
+            return False
+
+    def new_batch_out_dir(self):
+        self.batch_dir.mkdir(exist_ok=True)
+        return self.batch_dir / uuid.uuid4().hex
+
+    def recover(self):
+        """
+        Finishes off a merge which was interrupted, and removes the Guppy output of any batch
+        which never got to the merge.
+        """
+        if self.incomplete is not None:
+            record = self.incomplete
+            print('\nRecovering from an interrupted merge')
+            restore_outputs(self.out_dir, record['outputs'], record['summary_columns'],
+                            record.get('read_index'))
+            batch_out = self.batch_dir / record['begin']
+            if batch_out.is_dir():
+                self.merge_batch(record, batch_out)
+            else:
+                self.incomplete = None
+        if self.batch_dir.is_dir():
+            for batch_out in self.batch_dir.iterdir():
+                shutil.rmtree(str(batch_out), ignore_errors=True)
+
+    def commit(self, fast5s, batch_out, barcodes, compress, read_index=True, read_filter=None):
+        """
+        Merges a batch's Guppy output into the output files and records its fast5s as basecalled,
+        such that either both happen or (after recovery) neither does.
+        """
+        record = {'begin': batch_out.name, 'barcodes': barcodes, 'compress': compress,
+                  'fast5s': [self.key(f) for f in fast5s],
+                  'outputs': get_output_sizes(self.out_dir),
+                  'summary_columns': load_summary_columns_meta(self.out_dir /
+                                                               SUMMARY_COLUMNS_DIR),
+                  'read_index': load_read_index_manifest(self.out_dir / READ_INDEX_DIR)
+                  if read_index else None,
+                  'read_filter': read_filter.state() if read_filter is not None else None}
+        self.incomplete = record
+        self.write(record)
+        return self.merge_batch(record, batch_out)
+
+    def is_merging(self, batch_out):
+        """
+        Returns whether a batch's merge was begun but not committed, in which case its Guppy output
+        needs to stay put for recovery.
+        """
+        return self.incomplete is not None and self.incomplete['begin'] == batch_out.name
+
+    def merge_batch(self, record, batch_out):
+        read_filter = ReadFilter(*record['read_filter']) if record.get('read_filter') else None
+        merged_bytes = merge_results(batch_out, self.out_dir, record['barcodes'],
+                                     record['compress'], record.get('read_index') is not None,
+                                     read_filter)
+        sync_outputs(self.out_dir)
+        self.write({'commit': record['begin']})
+        self.basecalled.update(tuple(k) for k in record['fast5s'])
+        self.incomplete = None
+        shutil.rmtree(str(batch_out), ignore_errors=True)
+        return merged_bytes
+
+    def write(self, record):
+        with open(str(self.filename), 'at') as journal:
+            journal.write(json.dumps(record) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+
+
+def load_legacy_basecalled_filenames(out_dir):
+    """
+    Older versions of this script recorded basecalled fast5s by filename in basecalled_filenames.
+    """
     already_basecalled_files = set()
     already_basecalled_filename = out_dir / 'basecalled_filenames'
     if already_basecalled_filename.is_file():
@@ -163,12 +1035,53 @@ def load_already_basecalled(out_dir):
     return already_basecalled_files
 
 
-def add_to_already_basecalled(fast5s, out_dir):
-    already_basecalled_filename = out_dir / 'basecalled_filenames'
-    with open(str(already_basecalled_filename), 'at') as already_basecalled:
-        for fast5 in fast5s:
-            already_basecalled.write(fast5.name)
-            already_basecalled.write('\n')
+def get_output_filenames(out_dir):
+    filenames = []
+    for pattern in APPEND_ONLY_OUTPUTS:
+        filenames += out_dir.glob(pattern)
+    return filenames
+
+
+def get_output_sizes(out_dir):
+    return {f.name: f.stat().st_size for f in get_output_filenames(out_dir)}
+
+
+def sync_outputs(out_dir):
+    for filename in get_output_filenames(out_dir):
+        with open(str(filename), 'rb') as f:
+            os.fsync(f.fileno())
+
+
+def restore_outputs(out_dir, sizes, summary_columns_meta, read_index_manifest=None):
+    """
+    Puts the append-only output files back to the sizes they were before a merge started. BGZF
+    files and their indices need a little more than truncation: the EOF block is rewritten and
+    the index's entry count is corrected. The summary columns and read index go back to their
+    saved metadata.
+    """
+    for filename in get_output_filenames(out_dir):
+        if filename.name not in sizes:
+            filename.unlink()
+            continue
+        size = sizes[filename.name]
+        if filename.stat().st_size == size:
+            continue
+        with open_for_update(str(filename)) as f:
+            if filename.name.endswith('.gz') and size >= len(BGZF_EOF):
+                f.truncate(size - len(BGZF_EOF))
+                f.seek(0, os.SEEK_END)
+                f.write(BGZF_EOF)
+            elif filename.name.endswith('.gzi') and size >= 8:
+                f.truncate(size)
+                f.write(struct.pack('<Q', (size - 8) // 16))
+            else:
+                f.truncate(size)
+    columns_dir = out_dir / SUMMARY_COLUMNS_DIR
+    if columns_dir.is_dir():
+        with write_atomically(columns_dir / 'columns.json') as meta_file:
+            json.dump(summary_columns_meta, meta_file)
+    if read_index_manifest is not None:
+        ReadIndex(out_dir, read_index_manifest).save()
 
 
 def print_basecalling_message():
@@ -189,141 +1102,1289 @@ def print_waiting_message(waiting):
         print('\n\nWaiting for new reads (Ctrl-C to quit)', end='', flush=True)
 
 
-def basecall_reads(new_fast5s, barcodes, model, cpu, out_dir):
+def basecall_reads(new_fast5s, ledger, command, barcodes, model, cpu, server=None, temp_dir=None,
+                   compress=False, metrics=None, read_index=True, read_filter=None):
     print_basecalling_message()
-    with tempfile.TemporaryDirectory() as temp_dir:
-        temp_in = pathlib.Path(temp_dir) / 'in'
-        temp_out = pathlib.Path(temp_dir) / 'out'
-        copy_reads_to_temp_in(new_fast5s, temp_in)
-        guppy_command = get_guppy_command(temp_in, temp_out, barcodes, model, cpu)
-        execute_with_output(guppy_command)
-        merge_results(temp_out, out_dir, barcodes)
-    add_to_already_basecalled(new_fast5s, out_dir)
+    batch = Batch(new_fast5s, ledger, temp_dir=temp_dir, metrics=metrics)
+    try:
+        batch.stage()
+        batch.basecall(command, barcodes, model, cpu, server)
+        batch.merge(barcodes, compress, read_index, read_filter)
+    finally:
+        batch.cleanup()
+
+
+class Batch(object):
+    """
+    A batch of fast5s on its way through basecalling. Each step is a separate method so the
+    pipelined mode can run the steps for different batches at the same time.
+    """
+    def __init__(self, fast5s, ledger, all_fast5s=None, temp_dir=None, metrics=None,
+                 position=None, catch_up=False):
+        self.fast5s = fast5s
+        self.ledger = ledger
+        self.all_fast5s = all_fast5s
+        self.metrics = metrics
+        self.position = position
+        self.catch_up = catch_up
+        self.fast5_bytes, self.reads = 0, 0
+        self.temp_dir = tempfile.TemporaryDirectory(dir=None if temp_dir is None else str(temp_dir))
+        self.temp_in = pathlib.Path(self.temp_dir.name) / 'in'
+
+        # Guppy's output goes in the output directory (rather than the temp directory) so it
+        # survives a crash during the merge. See Ledger.
+        self.temp_out = ledger.new_batch_out_dir()
+
+    def measure(self, stage_name):
+        return measure_stage(self.metrics, stage_name, self.temp_out.name)
+
+    def stage(self):
+        with self.measure('stage') as stage:
+            stage_reads_to_temp_in(self.fast5s, self.temp_in)
+            self.fast5_bytes = sum(f.stat().st_size for f in self.temp_in.iterdir())
+            stage.items, stage.bytes = len(self.fast5s), self.fast5_bytes
+
+    def basecall(self, command, barcodes, model, cpu, server=None, cpu_threads=None,
+                 log_filename=None):
+        with self.measure('basecall') as stage:
+            self.run_basecaller(command, barcodes, model, cpu, server, cpu_threads, log_filename)
+            stage.items, stage.bytes = self.reads, self.fast5_bytes
+
+    def run_basecaller(self, command, barcodes, model, cpu, server, cpu_threads, log_filename):
+        if server is not None:
+            server.ensure_running()
+        guppy_command = get_guppy_command(command, self.temp_in, self.temp_out, barcodes, model,
+                                          cpu, server, cpu_threads)
+        try:
+            metrics = execute_with_output(guppy_command, log_filename)
+        except subprocess.CalledProcessError:
+            if server is None or server.stopped or server.is_healthy():
+                raise
+            # The server died while this batch was running, so restart it and try again.
+            print('WARNING: basecall server stopped responding, restarting it')
+            shutil.rmtree(str(self.temp_out), ignore_errors=True)
+            server.ensure_running()
+            metrics = execute_with_output(guppy_command, log_filename)
+        shutil.rmtree(str(self.temp_in), ignore_errors=True)
+        self.reads = count_summary_reads(self.temp_out / 'sequencing_summary.txt')
+        log_guppy_metrics(self.ledger.out_dir, self.temp_out.name, metrics, self.reads)
+
+    def merge(self, barcodes, compress=False, read_index=True, read_filter=None):
+        with self.measure('merge') as stage:
+            stage.bytes = self.ledger.commit(self.fast5s, self.temp_out, barcodes, compress,
+                                             read_index, read_filter)
+            stage.items = self.reads
+
+    def cleanup(self):
+        self.temp_dir.cleanup()
+        if not self.ledger.is_merging(self.temp_out):
+            shutil.rmtree(str(self.temp_out), ignore_errors=True)
+
+
+class Pipeline(object):
+    """
+    This class runs basecalling and merging in their own threads, so batch N+1 can be staged
+    (in the main thread) while batch N is basecalled and batch N-1 is merged (the summaries are
+    refreshed by the SummaryWorker's thread).
+    The bounded queues between the stages stop staging from getting too far ahead.
+
+    With --workers, there are several basecalling threads, each running its own Guppy on its
+    share of the CPU threads. There is still only one merging thread (so only one thread ever
+    writes to the output files), and it merges batches in the order they finish basecalling.
+    With one worker, batches are merged in the same order as in serial mode.
+    """
+    def __init__(self, args, summary_worker, server):
+        self.args = args
+        self.summary_worker = summary_worker
+        self.server = server
+        self.to_basecall = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        self.to_merge = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        self.no_more_batches = threading.Event()
+        self.no_more_merges = threading.Event()
+        self.stopping = threading.Event()
+        self.error = None
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.cpu_threads = get_cpu_threads_per_worker(args.workers) if args.workers > 1 else None
+        self.workers = WorkerStats(args.workers, args.out_dir)
+        self.basecall_threads = [threading.Thread(target=self.run_stage, daemon=True,
+                                                  args=(self.to_basecall, self.no_more_batches,
+                                                        self.basecall, self.to_merge, i))
+                                 for i in range(args.workers)]
+        self.merge_thread = threading.Thread(target=self.run_stage, daemon=True,
+                                             args=(self.to_merge, self.no_more_merges,
+                                                   self.merge, None, None))
+        for thread in self.basecall_threads + [self.merge_thread]:
+            thread.start()
+
+    def submit(self, position, fast5s, all_fast5s, catch_up=False):
+        batch = Batch(fast5s, position.ledger, all_fast5s, self.args.temp_dir, position.metrics,
+                      position, catch_up)
+        with self.lock:
+            self.in_flight += 1
+        try:
+            batch.stage()
+        except Exception:
+            batch.cleanup()
+            raise
+        self.put(self.to_basecall, batch)
+
+    def basecall(self, batch, worker):
+        args = self.args
+        if args.workers == 1:
+            print_basecalling_message()
+            log_filename = None
+        else:
+            print('\nWorker {}: basecalling {:,} fast5s'.format(worker + 1, len(batch.fast5s)),
+                  flush=True)
+            log_filename = args.out_dir / 'guppy_logs' / 'worker_{}_output.txt'.format(worker + 1)
+        self.workers.start(worker)
+        start_time = time.time()
+        try:
+            batch.basecall(args.basecaller_command, args.barcodes, args.model, args.cpu,
+                           self.server, self.cpu_threads, log_filename)
+        finally:
+            self.workers.finish(worker, len(batch.fast5s))
+        if batch.position.batch_sizer is not None:
+            batch.position.batch_sizer.observe(len(batch.fast5s), time.time() - start_time)
+
+    def merge(self, batch):
+        args = self.args
+        batch.merge(args.barcodes, args.compress, not args.no_read_index, args.read_filter)
+        batch.cleanup()
+        if batch.position.wants_summary(batch.catch_up):
+            self.summary_worker.request(batch.position, batch.all_fast5s)
+        if args.workers > 1:
+            self.workers.report()
+        with self.lock:
+            self.in_flight -= 1
+
+    def run_stage(self, in_queue, closed, action, out_queue, worker):
+        """
+        Runs one thread of a stage until the stage is closed (and its queue is empty) or the
+        pipeline is stopping.
+        """
+        while True:
+            if worker is not None and not self.workers.ready(worker):
+                if self.stopping.is_set():
+                    return
+                time.sleep(0.1)
+                continue
+            try:
+                batch = in_queue.get(timeout=1)
+            except queue.Empty:
+                if closed.is_set() or self.stopping.is_set():
+                    return
+                continue
+            if self.stopping.is_set():
+                batch.cleanup()
+                continue
+            try:
+                if worker is None:
+                    action(batch)
+                else:
+                    action(batch, worker)
+            except Exception as e:
+                self.error = e
+                self.stopping.set()
+                batch.cleanup()
+                continue
+            if out_queue is not None:
+                self.put(out_queue, batch)
+
+    def put(self, out_queue, batch):
+        """
+        Puts a batch on a queue, blocking while the queue is full (which is how the later stages
+        hold back the earlier ones). Checks regularly for a failure in one of the stages.
+        """
+        while True:
+            self.check()
+            if self.stopping.is_set() and threading.current_thread() is not \
+                    threading.main_thread():
+                batch.cleanup()
+                return
+            try:
+                out_queue.put(batch, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def check(self):
+        if self.error is not None and threading.current_thread() is threading.main_thread():
+            raise self.error
+
+    def is_idle(self):
+        self.check()
+        return self.in_flight == 0
+
+    def finish(self):
+        """
+        Waits for all submitted batches to be basecalled and merged.
+        """
+        self.no_more_batches.set()
+        self.join(self.basecall_threads)
+        self.no_more_merges.set()
+        self.join([self.merge_thread])
+        self.check()
+
+    def join(self, threads):
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=1)
+
+    def shutdown(self):
+        """
+        Stops the pipeline without waiting for queued batches. A merge which is already underway
+        is allowed to finish.
+        """
+        self.stopping.set()
+        terminate_running_processes()
+        for q in (self.to_basecall, self.to_merge):
+            while True:
+                try:
+                    batch = q.get_nowait()
+                except queue.Empty:
+                    break
+                batch.cleanup()
+        for thread in self.basecall_threads + [self.merge_thread]:
+            thread.join()
+
+
+def get_cpu_threads_per_worker(workers):
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+class WorkerStats(object):
+    """
+    Basecalling times for each worker, used to report how well the workers scale. The first
+    batch is basecalled by one worker on its own (the others wait for it) to measure the rate of
+    a worker without competition. Each worker's scaling efficiency is then its own rate divided
+    by that solo rate, i.e. 100% means running the workers side by side costs nothing.
+    """
+    def __init__(self, workers, out_dir):
+        self.filename = out_dir / 'worker_efficiency.tsv'
+        self.lock = threading.Lock()
+        self.start_time = None
+        self.running = {}  # worker -> whether another worker was running at the same time
+        self.started = {}  # worker -> start time of its current batch
+        self.batches = [0] * workers
+        self.fast5s = [0] * workers
+        self.seconds = [0.0] * workers
+        self.solo_fast5s, self.solo_seconds = 0, 0.0
+        self.calibrated = workers == 1
+
+    def ready(self, worker):
+        return self.calibrated or worker == 0
+
+    def start(self, worker):
+        with self.lock:
+            if self.start_time is None:
+                self.start_time = time.time()
+            for other in self.running:
+                self.running[other] = True
+            self.running[worker] = bool(self.running)
+            self.started[worker] = time.time()
+
+    def finish(self, worker, fast5s):
+        with self.lock:
+            seconds = time.time() - self.started.pop(worker)
+            overlapped = self.running.pop(worker)
+            self.batches[worker] += 1
+            self.fast5s[worker] += fast5s
+            self.seconds[worker] += seconds
+            if not overlapped:
+                self.solo_fast5s += fast5s
+                self.solo_seconds += seconds
+            self.calibrated = True
+
+    def solo_rate(self):
+        return self.solo_fast5s / self.solo_seconds if self.solo_seconds > 0.0 else None
+
+    def rows(self):
+        """
+        Returns one row per worker (and a total row) of: batches, fast5s, basecalling seconds,
+        fast5s per second, utilisation (fraction of the elapsed time spent basecalling) and
+        scaling efficiency.
+        """
+        with self.lock:
+            elapsed = time.time() - self.start_time if self.start_time is not None else 0.0
+            solo_rate = self.solo_rate()
+            rows = []
+            for i in range(len(self.batches)):
+                rate = self.fast5s[i] / self.seconds[i] if self.seconds[i] > 0.0 else None
+                utilisation = self.seconds[i] / elapsed if elapsed > 0.0 else None
+                efficiency = rate / solo_rate if rate is not None and solo_rate else None
+                rows.append([str(i + 1), self.batches[i], self.fast5s[i], self.seconds[i], rate,
+                             utilisation, efficiency])
+            total_fast5s = sum(self.fast5s)
+            rate = total_fast5s / elapsed if elapsed > 0.0 else None
+            efficiency = rate / (solo_rate * len(self.batches)) \
+                if rate is not None and solo_rate else None
+            rows.append(['all', sum(self.batches), total_fast5s, sum(self.seconds), rate,
+                         None, efficiency])
+        return rows
+
+    def report(self):
+        rows = self.rows()
+        table = [['worker', 'batches', 'fast5s', 'basecalling_seconds', 'fast5s_per_second',
+                  'utilisation', 'scaling_efficiency']]
+        for worker, batches, fast5s, seconds, rate, utilisation, efficiency in rows:
+            table.append([worker, str(batches), str(fast5s), '{:.1f}'.format(seconds),
+                          format_optional(rate, '{:.3f}'), format_optional(utilisation, '{:.3f}'),
+                          format_optional(efficiency, '{:.3f}')])
+        with write_atomically(self.filename) as tsv:
+            for row in table:
+                tsv.write('\t'.join(row) + '\n')
+
+        print('\n\n\n')
+        print('WORKERS')
+        print('------------------------------------------------------------')
+        print('worker  batches    fast5s  fast5s/s  utilisation  efficiency')
+        for row in table[1:]:
+            utilisation, efficiency = row[5], row[6]
+            if utilisation != '-':
+                utilisation = '{:.0%}'.format(float(utilisation))
+            if efficiency != '-':
+                efficiency = '{:.0%}'.format(float(efficiency))
+            print('{:>6}  {:>7}  {:>8}  {:>8}  {:>11}  {:>10}'.format(row[0], row[1], row[2],
+                                                                     row[4], utilisation,
+                                                                     efficiency))
+        print()
+
+
+class StageMetrics(object):
+    """
+    This class times each stage of each batch (see STAGES) and counts the bytes and items (fast5s,
+    reads or summary rows) the stage dealt with, so it's possible to see where the time goes when
+    basecalling falls behind. Every measurement is appended to stage_metrics.jsonl in the output
+    directory, along with the memory high-water marks of this process and of its largest child
+    (i.e. Guppy). Running totals are written to basecall_metrics.prom in Prometheus's text format,
+    ready for node_exporter's textfile collector.
+
+    With --profile, the summary stages are also run under cProfile and the accumulated stats are
+    saved to summary_profile.pstats (view them with Python's pstats module or snakeviz).
+    """
+    def __init__(self, out_dir, profile=False, position=None):
+        self.position = position  # a label for the Prometheus metrics, with several positions
+        self.log_filename = out_dir / 'stage_metrics.jsonl'
+        self.prometheus_filename = out_dir / 'basecall_metrics.prom'
+        self.profile_filename = out_dir / 'summary_profile.pstats'
+        self.profiler = cProfile.Profile() if profile else None
+        self.lock = threading.Lock()
+        self.runs = collections.Counter()
+        self.seconds = collections.Counter()
+        self.bytes = collections.Counter()
+        self.items = collections.Counter()
+        self.last_seconds = {}
+        self.backlog = 0
+
+    @contextlib.contextmanager
+    def measure(self, stage_name, batch=None):
+        """
+        Times the code in a with block. The block can fill in the bytes and items of the stage it
+        is given, or set discard to skip recording it. Nothing is recorded if the block fails.
+        """
+        stage = StageRecord()
+        profiling = self.profiler is not None and stage_name in PROFILED_STAGES
+        if profiling:
+            self.profiler.enable()
+        start_time = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            seconds = time.perf_counter() - start_time
+            if profiling:
+                self.profiler.disable()
+        if not stage.discard:
+            self.record(stage_name, batch, seconds, stage.bytes, stage.items)
+        if profiling:
+            self.profiler.dump_stats(str(self.profile_filename))
+
+    def set_backlog(self, fast5s):
+        self.backlog = fast5s
+
+    def record(self, stage_name, batch, seconds, byte_count, items):
+        max_rss, children_max_rss = get_max_rss()
+        entry = collections.OrderedDict([
+            ('time', datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')),
+            ('stage', stage_name), ('batch', batch), ('seconds', round(seconds, 6)),
+            ('bytes', byte_count), ('items', items), ('max_rss_bytes', max_rss),
+            ('children_max_rss_bytes', children_max_rss)])
+        with self.lock:
+            self.runs[stage_name] += 1
+            self.seconds[stage_name] += seconds
+            self.bytes[stage_name] += byte_count
+            self.items[stage_name] += items
+            self.last_seconds[stage_name] = seconds
+            with open(str(self.log_filename), 'at') as log:
+                log.write(json.dumps(entry) + '\n')
+            self.write_prometheus(max_rss, children_max_rss)
+
+    def write_prometheus(self, max_rss, children_max_rss):
+        """
+        Rewrites the Prometheus file (atomically, so the collector never sees half of it).
+        """
+        lines = []
+        stage_metrics = [
+            ('stage_runs_total', 'counter', 'Times each stage has run', self.runs),
+            ('stage_seconds_total', 'counter', 'Wall time spent in each stage', self.seconds),
+            ('stage_bytes_total', 'counter', 'Bytes handled by each stage', self.bytes),
+            ('stage_items_total', 'counter', 'Fast5s, reads or rows handled by each stage',
+             self.items),
+            ('stage_last_seconds', 'gauge', 'Wall time of the latest run of each stage',
+             self.last_seconds)]
+        for name, metric_type, description, values in stage_metrics:
+            add_prometheus_header(lines, name, metric_type, description)
+            for stage_name in STAGES:
+                if stage_name in values:
+                    lines.append('{}_{}{} {}'.format(PROMETHEUS_PREFIX, name,
+                                                     self.labels(stage=stage_name),
+                                                     format_prometheus(values[stage_name])))
+        process_metrics = [
+            ('backlog_fast5s', 'Fast5s found but not yet batched', self.backlog),
+            ('max_rss_bytes', 'Memory high-water mark of basecall.py', max_rss),
+            ('children_max_rss_bytes', 'Memory high-water mark of the largest child process',
+             children_max_rss),
+            ('last_update_timestamp_seconds', 'When these metrics were written', time.time())]
+        for name, description, value in process_metrics:
+            add_prometheus_header(lines, name, 'gauge', description)
+            lines.append('{}_{}{} {}'.format(PROMETHEUS_PREFIX, name, self.labels(),
+                                             format_prometheus(value)))
+        with write_atomically(self.prometheus_filename) as prom:
+            prom.write('\n'.join(lines) + '\n')
+
+    def labels(self, **labels):
+        if self.position is not None:
+            labels['position'] = self.position
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(key, prometheus_escape(labels[key]))
+                              for key in sorted(labels)) + '}'
+
+
+class StageRecord(object):
+    def __init__(self):
+        self.bytes = 0
+        self.items = 0
+        self.discard = False
+
+
+@contextlib.contextmanager
+def measure_stage(metrics, stage_name, batch=None):
+    """
+    Like StageMetrics.measure, but does nothing when metrics is None.
+    """
+    if metrics is None:
+        yield StageRecord()
+    else:
+        with metrics.measure(stage_name, batch) as stage:
+            yield stage
+
+
+def get_max_rss():
+    """
+    Returns the peak resident memory (in bytes) of this process and of its largest finished child
+    process. Linux gives ru_maxrss in kilobytes, macOS in bytes.
+    """
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+def add_prometheus_header(lines, name, metric_type, description):
+    lines.append('# HELP {}_{} {}.'.format(PROMETHEUS_PREFIX, name, description))
+    lines.append('# TYPE {}_{} {}'.format(PROMETHEUS_PREFIX, name, metric_type))
+
+
+def prometheus_escape(label_value):
+    return label_value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
 
+def format_prometheus(value):
+    return '{:.6f}'.format(value) if isinstance(value, float) else str(value)
 
-def copy_reads_to_temp_in(new_fast5s, temp_in):
+
+def format_optional(value, format_string):
+    return '-' if value is None else format_string.format(value)
+
+
+def sleep_and_check(seconds, pipeline):
+    """
+    Sleeps, but wakes up every second to check whether the pipeline has failed.
+    """
+    end_time = time.time() + seconds
+    while time.time() < end_time:
+        if pipeline is not None:
+            pipeline.check()
+        time.sleep(min(1.0, max(0.0, end_time - time.time())))
+
+
+def stage_reads_to_temp_in(new_fast5s, temp_in):
     temp_in.mkdir()
     plural = '' if len(new_fast5s) == 1 else 's'
     print('Read{} to be basecalled:'.format(plural))
+    methods = collections.Counter()
     for f in new_fast5s:
 
         # Make sure that we aren't overwriting files in the temp directory. If so, give the new
         # file a unique name.
         new_path = temp_in / f.name
-        while new_path.is_file():
+        while os.path.lexists(str(new_path)):
             new_path = temp_in / (str(uuid.uuid4()) + '.fast5')
 
-        shutil.copy(str(f), str(new_path))
+        methods[stage_file(f, new_path)] += 1
         print('    {}'.format(str(f)))
+    print('Staged by {}'.format(', '.join('{} ({})'.format(m, c) for m, c in methods.items())))
     print()
 
 
-def summary_info(out_dir, barcodes, all_fast5s, trans_window):
-    translocation_speed_summary(out_dir, all_fast5s, trans_window)
+def stage_file(source, destination):
+    """
+    Puts a fast5 into Guppy's input directory without copying it if possible. Hardlinks and
+    reflinks are tried first, since Guppy then sees an ordinary file. A symlink is next, and a
+    copy is the last resort. Returns the name of the method that worked.
+    """
+    try:
+        os.link(str(source), str(destination))
+        return 'hardlink'
+    except OSError:
+        pass
+    if reflink(source, destination):
+        return 'reflink'
+    try:
+        os.symlink(str(source.resolve()), str(destination))
+        return 'symlink'
+    except OSError:
+        pass
+    shutil.copy(str(source), str(destination))
+    return 'copy'
+
+
+def reflink(source, destination):
+    """
+    Makes a copy-on-write clone of the file (supported by Btrfs, XFS and others on Linux).
+    """
+    try:
+        with open(str(source), 'rb') as src, open(str(destination), 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        try:
+            os.remove(str(destination))
+        except OSError:
+            pass
+        return False
+
+
+def update_summary(summary, run_start_times, out_dir, barcodes, all_fast5s, trans_window,
+                   metrics=None):
+    """
+    Takes in the newly merged reads and displays the summaries, timing each step.
+    """
+    with measure_stage(metrics, 'summary_update') as stage:
+        rows_before = summary.rows
+        summary.update(run_start_times, all_fast5s)
+        stage.items = summary.rows - rows_before
+    with measure_stage(metrics, 'summary_report') as stage:
+        summary_info(summary, out_dir, barcodes, trans_window)
+        stage.items = summary.rows
+
+
+class SummaryWorker(object):
+    """
+    This class refreshes the summaries in a background thread, so the next batch doesn't have to
+    wait for them. Refreshes are rate-limited to one per --summary_interval seconds for each
+    position, and requests which come in while a refresh is running (or waiting for the interval)
+    are coalesced into one, which covers everything merged by then. Each refresh works from a
+    snapshot of the merged data: the summary columns are only read up to the row count in their
+    metadata, which is written after a batch's rows, so a merge running at the same time doesn't
+    affect it.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.condition = threading.Condition()
+        self.requested = collections.OrderedDict()  # position -> all_fast5s from latest request
+        self.last_refresh = {}
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def request(self, position, all_fast5s):
+        self.check()
+        with self.condition:
+            self.requested[position] = all_fast5s
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.requested:
+                    if self.closed:
+                        return
+                    self.condition.wait()
+                    continue
+                waits = {p: self.time_until_refresh(p) for p in self.requested}
+                due = [p for p in self.requested if waits[p] <= 0.0]
+                if not due:
+                    self.condition.wait(min(waits.values()))
+                    continue
+                position = due[0]
+                all_fast5s = self.requested.pop(position)
+            try:
+                if len(self.args.positions) > 1:
+                    print('\n\n\nSUMMARY FOR {}'.format(position.name))
+                update_summary(position.summary, position.run_start_times, position.out_dir,
+                               self.args.barcodes, all_fast5s, self.args.trans_window,
+                               position.metrics)
+            except Exception as e:
+                self.error = e
+                return
+            finally:
+                self.last_refresh[position] = time.monotonic()
+
+    def time_until_refresh(self, position):
+        if self.closed or position not in self.last_refresh:
+            return 0.0
+        return self.last_refresh[position] + self.args.summary_interval - time.monotonic()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """
+        Does any refreshes which are still waiting (without waiting for the interval) and stops
+        the thread.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        while self.thread.is_alive():
+            self.thread.join(timeout=1)
+        self.check()
+
+
+def summary_info(summary, out_dir, barcodes, trans_window):
+    translocation_speed_summary(summary, out_dir, trans_window)
     if barcodes != 'none':
-        barcode_distribution_summary(out_dir, barcodes)
-    overall_summary(out_dir)
+        barcode_distribution_summary(summary, out_dir, barcodes)
+    overall_summary(summary)
 
 
-def translocation_speed_summary(out_dir, all_fast5s, time_window):
+class SummaryAggregator(object):
+    """
+    This class holds what the summaries need, collected from the typed columns which sit beside
+    the merged sequencing_summary.txt (see SummaryColumns). It remembers how many rows it has
+    already taken in, so each update only looks at the rows which were appended since the last
+    one. Its state is saved in the output directory, so a restarted run carries on from where the
+    last one stopped.
+    """
+    STATE_VERSION = 7
+    STATE_ATTRIBUTES = ['rows', 'run_ids', 'filtered']
+
+    def __init__(self, out_dir, read_filter=None):
+        self.out_dir = out_dir
+        self.state_filename = out_dir / 'summary_state.pickle'
+        self.read_filter = read_filter
+        self.reset()
+        self.load()
+
+    def reset(self):
+        self.rows = 0
+        self.run_ids = []
+        self.filtered = {}  # barcode -> [pass reads, pass bases, fail reads, fail bases]
+        self.lengths = LengthHistogram()
+        self.barcode_lengths = {}
+        self.translocation = TranslocationSeries()
+
+    def load(self):
+        if not self.state_filename.is_file():
+            return
+        try:
+            with open(str(self.state_filename), 'rb') as state_file:
+                state = pickle.load(state_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            print('WARNING: could not load {}, rebuilding summary'.format(self.state_filename))
+            return
+        if state.get('version') != self.STATE_VERSION:
+            return
+        read_filter = self.read_filter.state() if self.read_filter is not None else None
+        if state.get('read_filter') != read_filter:  # the pass/fail counts need redoing
+            return
+
+        # If there are now fewer rows than we've already taken in, the summary isn't the one our
+        # saved state came from, so we need to start over.
+        if SummaryColumns.row_count(self.out_dir) < state['rows']:
+            return
+        for key in self.STATE_ATTRIBUTES:
+            setattr(self, key, state[key])
+        self.lengths = LengthHistogram(state['lengths'])
+        self.barcode_lengths = {name: LengthHistogram(histogram_state)
+                                for name, histogram_state in state['barcode_lengths'].items()}
+        self.translocation = TranslocationSeries(state['translocation'])
+
+    def save(self):
+        state = {key: getattr(self, key) for key in self.STATE_ATTRIBUTES}
+        state['version'] = self.STATE_VERSION
+        state['read_filter'] = self.read_filter.state() if self.read_filter is not None else None
+        state['lengths'] = self.lengths.state()
+        state['barcode_lengths'] = {name: histogram.state()
+                                    for name, histogram in self.barcode_lengths.items()}
+        state['translocation'] = self.translocation.state()
+        temp_filename = str(self.state_filename) + '.tmp'
+        with open(temp_filename, 'wb') as state_file:
+            pickle.dump(state, state_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_filename, str(self.state_filename))
+
+    def update(self, run_start_times, all_fast5s):
+        """
+        Takes in any rows which have been added to the summary columns since the last update.
+        """
+        with SummaryColumns(self.out_dir) as columns:
+            if columns.rows < self.rows:
+                self.reset()
+            if columns.rows == self.rows:
+                return
+            run_ids = columns.categories('run_id')
+            if not self.translocation.add_runs(self.new_run_starts(run_ids, run_start_times,
+                                                                   all_fast5s)):
+                # A new run started before the ones already binned, so their reads have to be
+                # binned again against the new earliest start.
+                self.reset()
+                self.translocation.add_runs(self.new_run_starts(run_ids, run_start_times,
+                                                                all_fast5s))
+            start, end = self.rows, columns.rows
+            self.run_ids = run_ids
+            barcode_names = columns.categories('barcode_arrangement')
+            lengths = columns.column('sequence_length_template', start, end)
+            barcodes = columns.column('barcode_arrangement', start, end)
+            if barcodes is None:
+                barcodes = itertools.repeat(None)
+            channels = columns.column('channel', start, end)
+            if channels is None:
+                channels = itertools.repeat(None)
+            for run_index, start_time, duration, length, qscore, barcode, channel in \
+                    zip(columns.column('run_id', start, end),
+                        columns.column('start_time', start, end),
+                        columns.column('duration', start, end),
+                        lengths, columns.column('mean_qscore_template', start, end),
+                        barcodes, channels):
+                self.lengths.add(length)
+                barcode = 'unclassified' if barcode is None else barcode_names[barcode]
+                if barcode not in self.barcode_lengths:
+                    self.barcode_lengths[barcode] = LengthHistogram()
+                self.barcode_lengths[barcode].add(length)
+                if self.read_filter is not None:
+                    self.add_filtered(barcode, length, qscore)
+                self.translocation.add(run_index, start_time, duration, length, qscore, channel)
+            self.rows = end
+        self.save()
+
+    def new_run_starts(self, run_ids, run_start_times, all_fast5s):
+        """
+        Returns the start times of the runs which the translocation series hasn't placed yet, by
+        run index.
+        """
+        return {i: run_start_times.get(run_id, all_fast5s) for i, run_id in enumerate(run_ids)
+                if i not in self.translocation.run_offsets}
+
+    def add_filtered(self, barcode, length, qscore):
+        if barcode not in self.filtered:
+            self.filtered[barcode] = [0, 0, 0, 0]
+        counts = self.filtered[barcode]
+        i = 0 if self.read_filter.passes(length, qscore) else 2
+        counts[i] += 1
+        counts[i + 1] += length
+
+
+class SummaryColumns(object):
+    """
+    Read-only access to the typed, append-only columns which merge_results keeps beside the merged
+    sequencing_summary.txt (in the sequencing_summary_columns directory). Each numeric column is a
+    file of fixed-width values and each categorical column (e.g. barcode_arrangement) is a file of
+    codes into a list of values kept in columns.json. The files are memory-mapped, so reading a
+    column doesn't parse anything or load more than is used. Columns come back as memoryviews,
+    which NumPy can wrap without copying, e.g.:
+        with SummaryColumns(pathlib.Path('out_dir')) as columns:
+            qscores = numpy.asarray(columns.column('mean_qscore_template'))
+    """
+    def __init__(self, out_dir):
+        self.directory = out_dir / SUMMARY_COLUMNS_DIR
+        self.meta = load_summary_columns_meta(self.directory)
+        self.rows = self.meta['rows']
+        self.maps, self.views = {}, []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def row_count(out_dir):
+        return load_summary_columns_meta(out_dir / SUMMARY_COLUMNS_DIR)['rows']
+
+    def names(self):
+        return list(self.meta['columns'])
+
+    def column(self, name, start=0, end=None):
+        """
+        Returns a column (or a slice of rows from it), or None if the summary doesn't have it.
+        """
+        if name not in self.meta['columns']:
+            return None
+        type_code = self.meta['columns'][name]
+        end = self.rows if end is None else end
+        if name not in self.maps:
+            if self.rows == 0:
+                return memoryview(b'').cast(type_code)
+            with open(str(self.directory / name), 'rb') as column_file:
+                self.maps[name] = mmap.mmap(column_file.fileno(), 0, access=mmap.ACCESS_READ)
+        item_size = array.array(type_code).itemsize
+        view = memoryview(self.maps[name])[start * item_size:end * item_size].cast(type_code)
+        self.views.append(view)
+        return view
+
+    def categories(self, name):
+        return list(self.meta['categories'].get(name, []))
+
+    def close(self):
+        """
+        Unmaps the columns, unless something (e.g. a NumPy array) is still using them, in which
+        case they are left to be unmapped when they're garbage collected.
+        """
+        try:
+            for view in self.views:
+                view.release()
+            for column_map in self.maps.values():
+                column_map.close()
+        except BufferError:
+            pass
+        self.views, self.maps = [], {}
+
+
+class LengthHistogram(object):
+    """
+    This class counts read lengths so that Nx values can be found without keeping or sorting every
+    length. Lengths below EXACT_LENGTH_LIMIT are counted exactly. Longer ones go in bins which are
+    LENGTH_BIN_RATIO wide, each of which also keeps its total bases, so the cumulative totals are
+    always exact and only a length which falls in one of those bins is approximate (the mean of
+    its bin). The bins are also summed in blocks, so a query only needs to look at a few hundred
+    blocks and then the bins inside one block.
+    """
+    BLOCK_SIZE = 256
+
+    def __init__(self, state=None):
+        self.reads, self.bases = 0, 0
+        self.counts, self.long_bases = None, None  # created when the first read is added
+        self.block_counts, self.block_bases = None, None
+        if state is not None:
+            self.load_state(state)
+
+    def state(self):
+        """
+        Most bins are empty, so only the non-empty ones are saved, and blocks with no reads aren't
+        looked at.
+        """
+        bins, counts, bases = array.array('I'), array.array('I'), array.array('Q')
+        if self.counts is not None:
+            for block, block_count in enumerate(self.block_counts):
+                if not block_count:
+                    continue
+                start = block * self.BLOCK_SIZE
+                for i in range(start, min(start + self.BLOCK_SIZE, len(self.counts))):
+                    if self.counts[i]:
+                        bins.append(i)
+                        counts.append(self.counts[i])
+                        bases.append(self.bin_bases(i))
+        return bins, counts, bases
+
+    def load_state(self, state):
+        for i, count, bases in zip(*state):
+            if self.counts is None:
+                self.allocate()
+            self.counts[i] += count
+            if i >= EXACT_LENGTH_LIMIT:
+                self.long_bases[i - EXACT_LENGTH_LIMIT] += bases
+            self.block_counts[i // self.BLOCK_SIZE] += count
+            self.block_bases[i // self.BLOCK_SIZE] += bases
+            self.reads += count
+            self.bases += bases
+
+    def allocate(self):
+        bin_count = EXACT_LENGTH_LIMIT + LONG_LENGTH_BINS
+        block_count = (bin_count + self.BLOCK_SIZE - 1) // self.BLOCK_SIZE
+        self.counts = array.array('I', bytes(4 * bin_count))
+        self.long_bases = array.array('Q', bytes(8 * LONG_LENGTH_BINS))
+        self.block_counts = array.array('Q', bytes(8 * block_count))
+        self.block_bases = array.array('Q', bytes(8 * block_count))
+
+    def add(self, length, count=1):
+        if self.counts is None:
+            self.allocate()
+        i = get_length_bin(length)
+        self.counts[i] += count
+        if i >= EXACT_LENGTH_LIMIT:
+            self.long_bases[i - EXACT_LENGTH_LIMIT] += length * count
+        self.block_counts[i // self.BLOCK_SIZE] += count
+        self.block_bases[i // self.BLOCK_SIZE] += length * count
+        self.reads += count
+        self.bases += length * count
+
+    def bin_bases(self, i):
+        if i < EXACT_LENGTH_LIMIT:
+            return i * self.counts[i]
+        return self.long_bases[i - EXACT_LENGTH_LIMIT]
+
+    def bin_length(self, i):
+        if i < EXACT_LENGTH_LIMIT:
+            return i
+        return int(round(self.long_bases[i - EXACT_LENGTH_LIMIT] / self.counts[i]))
+
+    def nx(self, fractions=(0.01, 0.1, 0.5, 0.9, 0.99)):
+        """
+        Returns a dictionary of fraction -> Nx length, e.g. {0.5: N50}. Like sorting the lengths
+        from longest to shortest, the Nx is the length of the read which takes the running total
+        of bases to x% of all bases.
+        """
+        results = {f: 0 for f in fractions}
+        if not self.reads:
+            return results
+        targets = sorted(fractions)
+        bases_so_far = 0
+        for block in range(len(self.block_bases) - 1, -1, -1):
+            if not self.block_counts[block]:
+                continue
+            if bases_so_far + self.block_bases[block] < self.bases * targets[0]:
+                bases_so_far += self.block_bases[block]
+                continue
+            start = block * self.BLOCK_SIZE
+            for i in range(min(start + self.BLOCK_SIZE, len(self.counts)) - 1, start - 1, -1):
+                if not self.counts[i]:
+                    continue
+                bases_so_far += self.bin_bases(i)
+                while targets and bases_so_far >= self.bases * targets[0]:
+                    results[targets.pop(0)] = self.bin_length(i)
+                if not targets:
+                    return results
+        return results
+
+    def n50(self):
+        return self.nx([0.5])[0.5]
+
+
+def get_length_bin(length):
+    if length < EXACT_LENGTH_LIMIT:
+        return length
+    long_bin = int(math.log(length / EXACT_LENGTH_LIMIT) / math.log1p(LENGTH_BIN_RATIO))
+    return EXACT_LENGTH_LIMIT + min(long_bin, LONG_LENGTH_BINS - 1)
+
+
+class TranslocationSeries(object):
+    """
+    This class holds sketches of the translocation speed and qscore for each minute since the
+    earliest run started (and for each channel). Each read is put in its minute bin once, as it
+    arrives, and the report for any window size is made by merging the bins, so memory use depends
+    on the length of the run, not the number of reads.
+    """
+    BIN_SECONDS = 60
+
+    def __init__(self, state=None):
+        self.anchor = None      # start time of the earliest run
+        self.run_offsets = {}   # run index -> seconds from the anchor to the run's start
+        self.bins = {}          # minute since the anchor -> (speed sketch, qscore sketch)
+        self.channels = {}      # channel number -> (speed sketch, qscore sketch)
+        if state is not None:
+            self.anchor = state['anchor']
+            self.run_offsets = state['run_offsets']
+            for key, sketch_states in state['bins'].items():
+                self.bins[key] = tuple(QuantileSketch.from_state(s) for s in sketch_states)
+            for key, sketch_states in state['channels'].items():
+                self.channels[key] = tuple(QuantileSketch.from_state(s) for s in sketch_states)
+
+    def state(self):
+        return {'anchor': self.anchor, 'run_offsets': self.run_offsets,
+                'bins': {k: tuple(s.state() for s in v) for k, v in self.bins.items()},
+                'channels': {k: tuple(s.state() for s in v) for k, v in self.channels.items()}}
+
+    def add_runs(self, run_starts):
+        """
+        Places new runs (a dict of run index -> start time) on the shared timeline. Returns False
+        if one started before the earliest run already placed, since the existing bins would then
+        all need shifting.
+        """
+        if not run_starts:
+            return True
+        earliest = min(run_starts.values())
+        if self.anchor is None:
+            self.anchor = earliest
+        elif earliest < self.anchor:
+            return False
+        for run_index, run_start in run_starts.items():
+            self.run_offsets[run_index] = (run_start - self.anchor).total_seconds()
+        return True
+
+    def add(self, run_index, start_time, duration, length, qscore, channel):
+        if duration <= 0.0:
+            return
+        speed = length / duration
+        minute = int((self.run_offsets.get(run_index, 0.0) + start_time) // self.BIN_SECONDS)
+        targets = [self.bins.setdefault(minute, new_speed_and_qscore_sketches())]
+        if channel is not None:
+            targets.append(self.channels.setdefault(channel, new_speed_and_qscore_sketches()))
+        for speed_sketch, qscore_sketch in targets:
+            speed_sketch.add(speed)
+            qscore_sketch.add(qscore)
+
+    def windows(self, window_minutes):
+        """
+        Merges the minute bins into windows of the given size. Returns a list of (speed, qscore)
+        sketches, one per window, starting from the earliest run's start (None for empty windows).
+        """
+        windows = {}
+        for minute, (speed, qscore) in self.bins.items():
+            window = minute // window_minutes
+            if window not in windows:
+                windows[window] = new_speed_and_qscore_sketches()
+            windows[window][0].merge(speed)
+            windows[window][1].merge(qscore)
+        if not windows:
+            return []
+        return [windows.get(i) for i in range(max(windows) + 1)]
+
+
+def new_speed_and_qscore_sketches():
+    return QuantileSketch(SPEED_RESOLUTION), QuantileSketch(QSCORE_RESOLUTION)
+
+
+class QuantileSketch(object):
+    """
+    A histogram of values rounded to a fixed resolution. It answers quantile queries to within
+    half the resolution without keeping every value, and sketches can be merged.
+    """
+    def __init__(self, resolution, counts=None):
+        self.resolution = resolution
+        self.counts = {} if counts is None else counts
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(*state)
+
+    def state(self):
+        return self.resolution, self.counts
+
+    def add(self, value):
+        key = int(round(value / self.resolution))
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def merge(self, other):
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+
+    def count(self):
+        return sum(self.counts.values())
+
+    def quantile(self, fraction):
+        """
+        Interpolates between the closest ranks, like statistics.median does for the middle.
+        """
+        position = fraction * (self.count() - 1)
+        lower_rank, upper_rank = math.floor(position), math.ceil(position)
+        lower_value, upper_value, rank_so_far = None, None, 0
+        for key in sorted(self.counts):
+            rank_so_far += self.counts[key]
+            if lower_value is None and rank_so_far > lower_rank:
+                lower_value = key * self.resolution
+            if rank_so_far > upper_rank:
+                upper_value = key * self.resolution
+                break
+        return lower_value + (upper_value - lower_value) * (position - lower_rank)
+
+    def median(self):
+        return self.quantile(0.5)
+
+
+def get_index(value, indices, values):
+    """
+    Returns the index of a value in a list of values, adding it to the end if it's new.
+    """
+    try:
+        return indices[value]
+    except KeyError:
+        indices[value] = len(values)
+        values.append(value)
+        return indices[value]
+
+
+def translocation_speed_summary(summary, out_dir, time_window):
     print('\n\n\n')
     print('TRANSLOCATION SPEED')
     print('------------------------------------------------------------')
-    data = read_sequencing_summary(out_dir, ['run_id', 'start_time', 'duration',
-                                             'sequence_length_template', 'mean_qscore_template'])
-    run_ids = set(x[0] for x in data)
-    run_start_times = {r: get_run_start_time(r, all_fast5s) for r in run_ids}
-    earliest_start_time = min(run_start_times.values())
-    read_trans_speeds = []
-    max_time = 0.0
-    for run_id, start_time, duration, length, qscore in data:
-        start_time, duration, length, qscore = \
-            float(start_time), float(duration), int(length), float(qscore)
-        trans_speed = length / duration
-        read_time = (run_start_times[run_id] + datetime.timedelta(seconds=start_time) -
-                     earliest_start_time).total_seconds() / 60.0
-        max_time = max(max_time, read_time)
-        read_trans_speeds.append((read_time, trans_speed, qscore))
-
-    with open(str(out_dir / 'translocation_speed.tsv'), 'wt') as trans_speed_file:
+    if not summary.run_ids:
+        return
+    windows = summary.translocation.windows(time_window)
+
+    with write_atomically(out_dir / 'translocation_speed.tsv') as trans_speed_file:
         print('Time window     Speed    Qscore')
         trans_speed_file.write('minute_window_start\tminute_window_end\t'
                                'translocation_speed\tmean_qscore\n')
-        window_start, window_end = 0, time_window
-        while window_start < max_time:
-            window_data = [x for x in read_trans_speeds if window_start <= x[0] < window_end]
-            window_count = len(window_data)
-
-            if window_count > 0:
-                median_speed = statistics.median([x[1] for x in window_data])
-                median_speed = '{:5.1f}'.format(median_speed)
-                median_qscore = statistics.median([x[2] for x in window_data])
-                median_qscore = '{:4.1f}'.format(median_qscore)
-            else:
-                median_speed, median_qscore = '', ''
-
+        for i, sketches in enumerate(windows):
+            window_start, window_end = i * time_window, (i + 1) * time_window
+            median_speed, median_qscore = format_speed_and_qscore(sketches)
             print('{:4d} - {:4d}     {}      {}'.format(window_start, window_end,
                                                         median_speed, median_qscore))
             trans_speed_file.write('{}\t{}\t{}\t{}\n'.format(window_start, window_end,
                                                              median_speed, median_qscore))
-            window_start += time_window
-            window_end += time_window
+
+    if summary.translocation.channels:
+        with write_atomically(out_dir / 'translocation_speed_by_channel.tsv') as channel_file:
+            channel_file.write('channel\treads\ttranslocation_speed\tmean_qscore\n')
+            for channel in sorted(summary.translocation.channels):
+                sketches = summary.translocation.channels[channel]
+                median_speed, median_qscore = format_speed_and_qscore(sketches)
+                channel_file.write('{}\t{}\t{}\t{}\n'.format(channel, sketches[0].count(),
+                                                               median_speed.strip(),
+                                                               median_qscore.strip()))
 
     # TODO: draw an ASCII plot showing the mean translocation speeds for time windows?
 
 
-def get_run_start_time(run_id, fast5s):
-    random.shuffle(fast5s)  # in case the ones we need are at the end
-    def get_run_id(_, node):
-        try:
-            return node.attrs['run_id'].decode()
-        except (AttributeError, KeyError):
-            pass
+def format_speed_and_qscore(sketches):
+    if sketches is None:
+        return '', ''
+    return '{:5.1f}'.format(sketches[0].median()), '{:4.1f}'.format(sketches[1].median())
 
-    def get_exp_start_time(_, node):
-        try:
-            return node.attrs['exp_start_time'].decode()
-        except (AttributeError, KeyError):
-            pass
 
+class RunStartTimes(object):
+    """
+    This class caches the exp_start_time for each run_id, so each run only needs to be looked up
+    once. Start times are recorded as fast5s are staged for basecalling and saved in the output
+    directory, so they survive a restart.
+    """
+    def __init__(self, out_dir):
+        self.filename = out_dir / 'run_start_times.tsv'
+        self.start_times = {}
+        self.missing = set()
+        self.lock = threading.Lock()  # runs are recorded and looked up in different threads
+        if self.filename.is_file():
+            with open(str(self.filename), 'rt') as start_times_file:
+                for line in start_times_file:
+                    run_id, exp_start_time = line.rstrip('\n').split('\t')
+                    self.start_times[run_id] = dateutil.parser.parse(exp_start_time)
+
+    def record(self, fast5s):
+        for fast5 in fast5s:
+            run_id, exp_start_time = read_run_start_time(fast5)
+            if run_id is None or exp_start_time is None or run_id in self.start_times:
+                continue
+            if not self.add(run_id, exp_start_time):
+                print('WARNING: could not parse exp_start_time in {}'.format(fast5))
+
+    def add(self, run_id, exp_start_time):
+        """
+        Records the start time for the run, returning False if it couldn't be parsed.
+        """
+        with self.lock:
+            if run_id in self.start_times:
+                return True
+            try:
+                self.start_times[run_id] = dateutil.parser.parse(exp_start_time)
+            except (ValueError, OverflowError):
+                return False
+            with open(str(self.filename), 'at') as start_times_file:
+                start_times_file.write('{}\t{}\n'.format(run_id, exp_start_time))
+            return True
+
+    def get(self, run_id, fast5s):
+        """
+        Returns the start time for the run, falling back to searching the given fast5s if this
+        run hasn't been seen yet. Runs which can't be found are only searched for once.
+        """
+        if run_id in self.start_times:
+            return self.start_times[run_id]
+        if run_id not in self.missing:
+            exp_start_time = find_run_start_time(run_id, fast5s)
+            if exp_start_time is not None and self.add(run_id, exp_start_time):
+                return self.start_times[run_id]
+            print('WARNING: could not find exp_start_time in fast5')
+            self.missing.add(run_id)
+        return datetime.datetime.now()
+
+
+def read_run_start_time(fast5):
+    """
+    Returns the run_id and exp_start_time from a fast5 file. It first looks where MinKNOW puts
+    them (the tracking_id/context_tags groups of single-read and multi-read fast5s) and only walks
+    the whole HDF5 tree if that fails.
+    """
+    try:
+        with h5py.File(str(fast5), 'r') as f:
+            if 'UniqueGlobalKey' in f:
+                groups = ['UniqueGlobalKey']
+            else:
+                groups = [next((k for k in f.keys() if k.startswith('read_')), None)]
+            for group in groups:
+                if group is None:
+                    continue
+                for subgroup in ('tracking_id', 'context_tags'):
+                    path = group + '/' + subgroup
+                    if path not in f:
+                        continue
+                    attrs = f[path].attrs
+                    if 'run_id' in attrs and 'exp_start_time' in attrs:
+                        return decode_attr(attrs['run_id']), decode_attr(attrs['exp_start_time'])
+
+            def get_attr(name):
+                def visitor(_, node):
+                    if name in node.attrs:
+                        return decode_attr(node.attrs[name])
+                return visitor
+            return f.visititems(get_attr('run_id')), f.visititems(get_attr('exp_start_time'))
+    except OSError:
+        return None, None
+
+
+def find_run_start_time(run_id, fast5s):
     for fast5 in fast5s:
-        f = h5py.File(fast5, 'r')
-        fast5_run_id = f.visititems(get_run_id)
-        if run_id == fast5_run_id:
-            exp_start_time = f.visititems(get_exp_start_time)
-            return dateutil.parser.parse(exp_start_time)
-        f.close()
+        fast5_run_id, exp_start_time = read_run_start_time(fast5)
+        if run_id == fast5_run_id and exp_start_time is not None:
+            return exp_start_time
+    return None
+
 
-    print('WARNING: could not find exp_start_time in fast5')
-    return datetime.datetime.now()
+def decode_attr(value):
+    if isinstance(value, bytes):
+        return value.decode()
+    return str(value)
 
 
-def barcode_distribution_summary(out_dir, barcode_kit):
+def barcode_distribution_summary(summary, out_dir, barcode_kit):
     print('\n\n\n')
     print('BARCODE DISTRIBUTION')
     print('------------------------------------------------------------')
-    barcode_data = read_sequencing_summary(out_dir, ['sequence_length_template',
-                                                     'barcode_arrangement'])
     first_barcode = int(barcode_kit.split('_')[-1].split('-')[0])
     last_barcode = int(barcode_kit.split('_')[-1].split('-')[1])
     barcode_names = ['barcode{:02}'.format(i) for i in range(first_barcode, last_barcode + 1)]
     barcode_names.append('unclassified')
-    bases = {name: 0 for name in barcode_names}
-    reads = {name: 0 for name in barcode_names}
-    for length, name in barcode_data:
-        length = int(length)
-        bases[name] += length
-        reads[name] += 1
+    empty = LengthHistogram()
+    histograms = {name: summary.barcode_lengths.get(name, empty) for name in barcode_names}
+    bases = {name: histograms[name].bases for name in barcode_names}
+    reads = {name: histograms[name].reads for name in barcode_names}
     overall_total = sum(bases.values())
-    n50s = {}
-    for name in barcode_names:
-        n50s[name] = get_n50([int(x[0]) for x in barcode_data if x[1] == name])
+    n50s = {name: histograms[name].n50() for name in barcode_names}
 
     max_total_len = max(len('{:,}'.format(t)) for t in bases.values())
     total_format_str = '{:' + str(max_total_len) + ',} bp'
 
-    with open(str(out_dir / 'barcode_distribution.tsv'), 'wt') as barcode_file:
-        barcode_file.write('barcode\treads\tbases\tbases_percent\tN50\n')
+    # With --min_qscore/--min_length, the pass and fail reads and bases are reported too.
+    filtered = summary.read_filter is not None
+    header = ['barcode', 'reads', 'bases', 'bases_percent', 'N50']
+    if filtered:
+        header += ['pass_reads', 'pass_bases', 'fail_reads', 'fail_bases']
+
+    with write_atomically(out_dir / 'barcode_distribution.tsv') as barcode_file:
+        barcode_file.write('\t'.join(header) + '\n')
         for name in barcode_names:
             row = (name + ':').ljust(14)
             row += total_format_str.format(bases[name])
@@ -331,67 +2392,141 @@ def barcode_distribution_summary(out_dir, barcode_kit):
             row += ' {:.2f}%'.format(bases_percent).rjust(9)
             if n50s[name]:
                 row += '   N50 = {:6,} bp'.format(n50s[name])
+            values = [name, str(reads[name]), str(bases[name]), '{:.2f}'.format(bases_percent),
+                      str(n50s[name])]
+            if filtered:
+                counts = summary.filtered.get(name, [0, 0, 0, 0])
+                if bases[name]:
+                    row += '   pass = {:.1f}%'.format(100.0 * counts[1] / bases[name])
+                values += [str(c) for c in counts]
             print(row)
-            barcode_file.write('{}\t{}\t{}\t{:.2f}\t{}\n'.format(name, reads[name], bases[name],
-                                                                 bases_percent, n50s[name]))
+            barcode_file.write('\t'.join(values) + '\n')
     print()
 
     # TODO: for each barcode, draw an ASCII bar plot for the number of bases and the N50 read size?
 
 
-def overall_summary(out_dir):
+def overall_summary(summary):
     print('\n\n\n')
     print('TOTALS')
     print('------------------------------------------------------------')
-    sequence_lengths = read_sequencing_summary(out_dir, ['sequence_length_template'])
-    sequence_lengths = [int(x[0]) for x in sequence_lengths]
-    num_reads = len(sequence_lengths)
-    total_bases = sum(sequence_lengths)
-    n50 = get_n50(sequence_lengths)
+    num_reads = summary.lengths.reads
+    total_bases = summary.lengths.bases
+    n50 = summary.lengths.n50()
     print('Number of reads: {:14,}'.format(num_reads))
     print('Total bases:     {:14,}'.format(total_bases))
     print('Read N50:        {:14,}'.format(n50))
+    if summary.read_filter is not None:
+        counts = [sum(c[i] for c in summary.filtered.values()) for i in range(4)]
+        print('Passing reads:   {:14,}'.format(counts[0]))
+        print('Passing bases:   {:14,}'.format(counts[1]))
     print()
 
 
-def get_n50(sequence_lengths):
-    sequence_lengths = sorted(sequence_lengths, reverse=True)
-    total_bases = sum(sequence_lengths)
-    target_bases = total_bases * 0.5
-    bases_so_far = 0
-    for sequence_length in sequence_lengths:
-        bases_so_far += sequence_length
-        if bases_so_far >= target_bases:
-            return sequence_length
-    return 0
-
-
-def read_sequencing_summary(out_dir, columns):
-    summary_filename = str(out_dir / 'sequencing_summary.txt')
-    with open(summary_filename, 'rt') as summary:
-        headers = summary.readline().strip().split('\t')
-    column_numbers = [headers.index(x) for x in columns]
-    data = []
-    with open(summary_filename, 'rt') as summary:
-        for line in summary:
-            if line.startswith('filename'):
-                continue
-            parts = line.strip().split('\t')
-            data.append([parts[i] for i in column_numbers])
-    return data
-
-
-def get_guppy_command(in_dir, out_dir, barcodes, model, cpu):
-    guppy_command = ['guppy_basecaller',
-                     '--input_path', str(in_dir),
-                     '--save_path', str(out_dir)]
-    if not cpu:
+def get_guppy_command(command, in_dir, out_dir, barcodes, model, cpu, server=None,
+                      cpu_threads=None):
+    guppy_command = shlex.split(command) + ['--input_path', str(in_dir),
+                                            '--save_path', str(out_dir)]
+    if server is not None:
+        guppy_command += ['--port', str(server.port)]
+    elif not cpu:
         guppy_command += ['--device', 'auto']
+    if cpu_threads is not None:
+        guppy_command += ['--num_callers', '1', '--cpu_threads_per_caller', str(cpu_threads)]
     guppy_command += BASECALLING[model]
     guppy_command += BARCODING[barcodes]
     return guppy_command
 
 
+class BasecallServer(object):
+    """
+    A long-lived Guppy basecall server, so the model only has to be loaded once per run instead
+    of once per batch. Each batch is then basecalled by a guppy_basecaller client connected to the
+    server's port. If the server dies, it is restarted before the next batch.
+    """
+    def __init__(self, command, model, cpu, out_dir):
+        self.command = shlex.split(command)
+        self.model = model
+        self.cpu = cpu
+        self.log_dir = out_dir / 'guppy_server_logs'
+        self.process = None
+        self.port = None
+        self.stopped = False
+
+    def start(self):
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        self.port = get_free_port()
+        server_command = self.command + ['--port', str(self.port),
+                                         '--log_path', str(self.log_dir)]
+        if not self.cpu:
+            server_command += ['--device', 'auto']
+        server_command += BASECALLING[self.model]
+        print('\nSTARTING GUPPY BASECALL SERVER')
+        print(' '.join(server_command))
+        with open(str(self.log_dir / 'server_output.txt'), 'ab') as server_output:
+            self.process = subprocess.Popen(server_command, stdout=server_output,
+                                            stderr=subprocess.STDOUT)
+        RUNNING_PROCESSES.add(self.process)
+
+        start_time = time.time()
+        while not self.is_healthy():
+            if self.process.poll() is not None:
+                raise BasecallServerError('basecall server exited with code {} (see {})'
+                                          .format(self.process.returncode, self.log_dir))
+            if time.time() - start_time > SERVER_START_TIMEOUT:
+                self.stop()
+                raise BasecallServerError('basecall server did not start within {} seconds'
+                                          .format(SERVER_START_TIMEOUT))
+            time.sleep(0.5)
+        print('Server is listening on port {}'.format(self.port))
+
+    def is_healthy(self):
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            with socket.create_connection(('localhost', self.port), timeout=2):
+                return True
+        except OSError:
+            return False
+
+    def ensure_running(self):
+        if self.stopped or self.is_healthy():
+            return
+        print('WARNING: basecall server is not running, restarting it')
+        self.terminate()
+        self.start()
+
+    def stop(self):
+        self.stopped = True
+        self.terminate()
+
+    def terminate(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        RUNNING_PROCESSES.discard(self.process)
+        self.process = None
+
+
+class BasecallServerError(RuntimeError):
+    """
+    The basecall server couldn't be started. This is raised rather than exiting, since the server
+    may be (re)started in a pipeline thread, which passes the error on to the main thread.
+    """
+    pass
+
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
 def check_python_version():
     try:
         assert sys.version_info >= (3, 5)
@@ -512,23 +2647,143 @@ def get_colours_from_tput():
         return 1
 
 
-def execute_with_output(cmd):
+def execute_with_output(cmd, log_filename=None):
     """
-    Run a command and display its output.
-    https://stackoverflow.com/a/4417735/2438989
+    Run a command and display its output, returning the figures parsed from it (see
+    GuppyOutput). If a log filename is given (e.g. when several Guppys are running at once), the
+    output is appended to that file instead.
     """
-    print_formatted_guppy_command(cmd)
-    print()
+    if log_filename is None:
+        print_formatted_guppy_command(cmd)
+        print()
+        output = GuppyOutput(sys.stdout)
+        run_and_relay(cmd, output)
+        print()
+    else:
+        with open(str(log_filename), 'at') as log:
+            log.write(' '.join(cmd) + '\n')
+            output = GuppyOutput(log)
+            run_and_relay(cmd, output)
+    return output.metrics()
+
+
+def run_and_relay(cmd, output):
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    for c in iter(lambda: p.stdout.read(1), b''):
-        print(c.decode(), end='', flush=True)
+    RUNNING_PROCESSES.add(p)
+    fd = p.stdout.fileno()
+    while True:
+        data = os.read(fd, RELAY_CHUNK_SIZE)  # returns whatever is available, so stays live
+        if not data:
+            break
+        output.feed(data)
+    output.feed(b'', final=True)
     p.stdout.close()
     return_code = p.wait()
-    print()
+    RUNNING_PROCESSES.discard(p)
     if return_code:
         raise subprocess.CalledProcessError(return_code, cmd)
 
 
+class GuppyOutput(object):
+    """
+    This class passes Guppy's output on to the terminal (or a log file) as it arrives and picks
+    out its progress and throughput figures. The output is decoded incrementally, so multi-byte
+    characters split across chunks survive, and lines are split on carriage returns as well as
+    newlines, since progress can be redrawn in place. Guppy's progress bar is a line of up to 50
+    asterisks, each one 2% of the batch.
+    """
+    FOUND_FILES = re.compile(r'Found (\d+) (?:fast5 )?files? to process')
+    CALLER_TIME = re.compile(r'Caller time: (\d+) ms, Samples called: (\d+), '
+                             r'samples/s: ([0-9.eE+-]+)')
+    PROGRESS_BAR = re.compile(r'^\*+$')
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.partial_line = ''
+        self.start_time = time.time()
+        self.fast5s, self.samples, self.caller_ms, self.samples_per_second = None, None, None, None
+        self.progress = 0
+
+    def feed(self, data, final=False):
+        text = self.decoder.decode(data, final)
+        if not text:
+            return
+        self.sink.write(text)
+        self.sink.flush()
+        lines = re.split(r'[\r\n]', self.partial_line + text)
+        self.partial_line = lines.pop()
+        for line in lines:
+            self.parse(line)
+        self.parse_progress(self.partial_line)
+
+    def parse(self, line):
+        self.parse_progress(line)
+        found = self.FOUND_FILES.search(line)
+        if found:
+            self.fast5s = int(found.group(1))
+        caller_time = self.CALLER_TIME.search(line)
+        if caller_time:
+            self.caller_ms = int(caller_time.group(1))
+            self.samples = int(caller_time.group(2))
+            self.samples_per_second = float(caller_time.group(3))
+
+    def parse_progress(self, line):
+        line = line.strip()
+        if self.PROGRESS_BAR.match(line):
+            self.progress = min(100, 2 * len(line))
+
+    def metrics(self):
+        return {'fast5s': self.fast5s, 'samples': self.samples,
+                'caller_seconds': None if self.caller_ms is None else self.caller_ms / 1000,
+                'samples_per_second': self.samples_per_second,
+                'elapsed_seconds': time.time() - self.start_time, 'progress': self.progress}
+
+
+def log_guppy_metrics(out_dir, batch_name, metrics, reads):
+    """
+    Appends one batch's Guppy figures to guppy_metrics.tsv.
+    """
+    elapsed = metrics['elapsed_seconds']
+    values = [datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), batch_name,
+              format_optional(metrics['fast5s'], '{}'), str(reads),
+              format_optional(metrics['samples'], '{}'),
+              format_optional(metrics['caller_seconds'], '{:.3f}'),
+              format_optional(metrics['samples_per_second'], '{:.4g}'), '{:.3f}'.format(elapsed),
+              '{:.2f}'.format(reads / elapsed) if elapsed > 0.0 else '-',
+              str(metrics['progress'])]
+    metrics_filename = out_dir / 'guppy_metrics.tsv'
+    with GUPPY_METRICS_LOCK:
+        new_file = not metrics_filename.is_file()
+        with open(str(metrics_filename), 'at') as metrics_file:
+            if new_file:
+                metrics_file.write('\t'.join(GUPPY_METRICS_COLUMNS) + '\n')
+            metrics_file.write('\t'.join(values) + '\n')
+
+
+def count_summary_reads(summary_filename):
+    """
+    Returns the number of reads (lines after the header) in a sequencing summary file.
+    """
+    if not summary_filename.is_file():
+        return 0
+    lines = 0
+    with open(str(summary_filename), 'rb') as summary:
+        for chunk in iter(lambda: summary.read(MERGE_BUFFER_SIZE), b''):
+            lines += chunk.count(b'\n')
+    return max(0, lines - 1)
+
+
+def terminate_running_processes():
+    for p in list(RUNNING_PROCESSES):
+        if p.poll() is None:
+            p.terminate()
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+
 def print_formatted_guppy_command(cmd):
     cmd = ' '.join(cmd)
     cmd = cmd.replace('--save_path', '\\\n                 --save_path')
@@ -538,7 +2793,8 @@ def print_formatted_guppy_command(cmd):
     print(cmd)
 
 
-def merge_results(temp_out, out_dir, barcodes):
+def merge_results(temp_out, out_dir, barcodes, compress=False, read_index=False,
+                  read_filter=None):
     log_dir = out_dir / 'guppy_logs'
     log_filename = None
     for filename in temp_out.glob('**/guppy_basecaller_log*'):
@@ -551,42 +2807,645 @@ def merge_results(temp_out, out_dir, barcodes):
         new_filename = telemetry_dir / 'sequencing_telemetry-{}.js'.format(timestamp)
         shutil.copyfile(str(filename), str(new_filename))
 
+    start_time, merged_bytes = time.time(), 0
     for filename in temp_out.glob('**/sequencing_summary.txt'):
         destination_filename = out_dir / 'sequencing_summary.txt'
-        merge_summary(filename, destination_filename)
+        merged_bytes += merge_summary(filename, destination_filename)
+    update_summary_columns(out_dir)
 
+    index = ReadIndex(out_dir) if read_index else None
+    read_values = load_summary_read_values(temp_out) if read_filter is not None else None
     for filename in temp_out.glob('**/*.fastq'):
-        destination_filename = get_destination_filename(barcodes, out_dir, filename)
-        merge_fastq(filename, destination_filename)
+        # Only the part of the path inside the batch directory says which barcode the reads have,
+        # since the output directory could also have a barcode-like name.
+        destination_filename = get_destination_filename(barcodes, out_dir,
+                                                        filename.relative_to(temp_out), compress)
+        if read_filter is None:
+            sources = [(filename, destination_filename)]
+        else:
+            pass_filename, fail_filename = split_fastq(filename, read_filter, read_values)
+            sources = [(pass_filename, destination_filename),
+                       (fail_filename, get_fail_filename(destination_filename))]
+        for source, destination in sources:
+            if read_filter is not None and source.stat().st_size == 0:
+                continue
+            if index is not None:
+                index.add_fastq(source, destination)
+            merged_bytes += merge_fastq(source, destination)
+    if index is not None:
+        index.save()
+    print_merge_speed(merged_bytes, time.time() - start_time)
+    return merged_bytes
+
+
+def print_merge_speed(merged_bytes, seconds):
+    megabytes = merged_bytes / 1000000
+    speed = '' if seconds <= 0.0 else ' ({:.1f} MB/s)'.format(megabytes / seconds)
+    print('Merged {:,.1f} MB in {:.2f} s{}'.format(megabytes, seconds, speed))
+
+
+class ReadIndex(object):
+    """
+    This class keeps an on-disk index of where each read is in the merged fastqs, so reads can be
+    pulled out by ID (with 'basecall.py lookup') without scanning the files. The index is built
+    as each batch is merged, from the batch's own fastqs and the size of the merged fastqs before
+    they're appended to.
+
+    Each entry (see READ_INDEX_ENTRY) holds a 16-byte key for the read ID, which fastq the read is
+    in and the offset and length of its record. Read IDs are UUIDs, which makes them their own
+    key, and anything else is hashed (lookups check each read's header, so a collision can't give
+    the wrong read). Offsets are in the uncompressed data: for fastq.gz files, the .gzi index says
+    which block to start decompressing from.
+
+    Each batch adds a sorted run of entries to the read_index directory, and runs of similar sizes
+    are merged into one (like a log-structured merge tree), so there are only ever a few runs to
+    binary search. index.json lists the fastqs and the runs. It's replaced atomically after the
+    runs are written, and a copy goes in the ledger's begin record, so an interrupted merge can be
+    rolled back. Runs which are no longer listed are removed at the start of the next save.
+    """
+    def __init__(self, out_dir, manifest=None):
+        self.out_dir = out_dir
+        self.directory = out_dir / READ_INDEX_DIR
+        self.manifest = manifest if manifest is not None \
+            else load_read_index_manifest(self.directory)
+        self.entries = []
+
+    def add_fastq(self, source_filename, destination_filename):
+        """
+        Adds the reads in a batch's fastq, which is about to be appended to the given merged fastq.
+        """
+        files = self.manifest['files']
+        name = os.path.basename(destination_filename)
+        if name not in files:
+            files.append(name)
+        file_number = files.index(name)
+        start = get_uncompressed_size(destination_filename)
+        for read_id, offset, length in scan_fastq_records(source_filename):
+            self.entries.append(READ_INDEX_ENTRY.pack(read_id_key(read_id), file_number,
+                                                      start + offset, length))
+
+    def save(self):
+        self.directory.mkdir(exist_ok=True)
+        listed = {run['name'] for run in self.manifest['runs']}
+        for filename in self.directory.glob('*.run'):
+            if filename.name not in listed:
+                filename.unlink()
+        if self.entries:
+            self.entries.sort()
+            self.add_run(self.entries)
+            self.entries = []
+            runs = self.manifest['runs']
+            while len(runs) >= 2 and runs[-2]['count'] <= 2 * runs[-1]['count']:
+                older, newer = runs.pop(-2), runs.pop()
+                self.add_run(heapq.merge(self.read_run(older), self.read_run(newer)))
+        with write_atomically(self.directory / 'index.json') as manifest_file:
+            json.dump(self.manifest, manifest_file)
+
+    def add_run(self, entries):
+        name = uuid.uuid4().hex + '.run'
+        count = 0
+        with open(str(self.directory / name), 'wb') as run_file:
+            for entry in entries:
+                run_file.write(entry)
+                count += 1
+        self.manifest['runs'].append({'name': name, 'count': count})
+
+    def read_run(self, run):
+        entries_per_chunk = MERGE_BUFFER_SIZE // READ_INDEX_ENTRY.size
+        with open(str(self.directory / run['name']), 'rb') as run_file:
+            for chunk in iter(lambda: run_file.read(entries_per_chunk * READ_INDEX_ENTRY.size),
+                              b''):
+                for i in range(0, len(chunk), READ_INDEX_ENTRY.size):
+                    yield chunk[i:i + READ_INDEX_ENTRY.size]
+
+    def find(self, read_ids):
+        """
+        Returns a dictionary of read ID -> (fastq number, offset, length) for the given read IDs
+        which are in the index, found by binary searching each run.
+        """
+        keys = {read_id_key(r): r for r in read_ids}
+        locations = {}
+        for run in self.manifest['runs']:
+            if run['count'] == 0:
+                continue
+            with open(str(self.directory / run['name']), 'rb') as run_file:
+                with mmap.mmap(run_file.fileno(), 0, access=mmap.ACCESS_READ) as entries:
+                    for key, read_id in keys.items():
+                        i = find_run_entry(entries, run['count'], key)
+                        if i is not None:
+                            entry = entries[i * READ_INDEX_ENTRY.size:
+                                            (i + 1) * READ_INDEX_ENTRY.size]
+                            locations[read_id] = READ_INDEX_ENTRY.unpack(entry)[1:]
+        return locations
+
+
+def find_run_entry(entries, count, key):
+    """
+    Binary searches a run's entries (sorted by key) and returns the index of the one with the
+    given key, or None.
+    """
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        start = middle * READ_INDEX_ENTRY.size
+        middle_key = entries[start:start + 16]
+        if middle_key < key:
+            low = middle + 1
+        elif middle_key > key:
+            high = middle
+        else:
+            return middle
+    return None
+
 
+def load_read_index_manifest(directory):
+    if (directory / 'index.json').is_file():
+        with open(str(directory / 'index.json'), 'rt') as manifest_file:
+            return json.load(manifest_file)
+    return {'files': [], 'runs': []}
 
-def get_destination_filename(barcodes, out_dir, source_filename):
+
+def read_id_key(read_id):
+    try:
+        return uuid.UUID(read_id).bytes
+    except ValueError:
+        return hashlib.md5(read_id.encode()).digest()
+
+
+def scan_fastq_records(filename):
+    """
+    Yields the read ID, offset and length of each record in a (four-line) fastq file.
+    """
+    with open(str(filename), 'rb') as fastq:
+        offset = 0
+        for header in fastq:
+            length = len(header) + len(next(fastq, b'')) + len(next(fastq, b'')) + \
+                len(next(fastq, b''))
+            yield get_fastq_read_id(header), offset, length
+            offset += length
+
+
+def get_fastq_read_id(record):
+    parts = record[1:].split(None, 1)
+    return parts[0].decode() if parts else ''
+
+
+def get_uncompressed_size(filename):
+    if not os.path.isfile(filename):
+        return 0
+    if filename.endswith('.gz'):
+        return find_bgzf_end(filename, filename + '.gzi')[1]
+    return os.path.getsize(filename)
+
+
+def get_destination_filename(barcodes, out_dir, source_filename, compress=False):
+    extension = '.fastq.gz' if compress else '.fastq'
     if barcodes == 'none':
-        return str(out_dir / 'reads.fastq')
+        return str(out_dir / ('reads' + extension))
     else:
         match = re.search(r'barcode\d\d', str(source_filename))
         if match:
             barcode = match.group(0)
         else:
             barcode = 'unclassified'
-        return str(out_dir / (barcode + '.fastq'))
+        return str(out_dir / (barcode + extension))
+
+
+def get_fail_filename(destination_filename):
+    directory, name = os.path.split(destination_filename)
+    return os.path.join(directory, name.replace('.fastq', '_fail.fastq', 1))
+
+
+class ReadFilter(object):
+    """
+    The --min_qscore and --min_length thresholds which split reads into pass and fail. Qscores
+    are compared at single precision, as that's how the summary columns store them, so a read
+    gets the same verdict in the merge (from the batch's summary text) and in the summaries.
+    """
+    def __init__(self, min_qscore=None, min_length=None):
+        self.min_qscore = None if min_qscore is None else to_single_precision(min_qscore)
+        self.min_length = min_length
+
+    def passes(self, length, qscore):
+        if self.min_length is not None and length < self.min_length:
+            return False
+        return self.min_qscore is None or to_single_precision(qscore) >= self.min_qscore
+
+    def state(self):
+        return [self.min_qscore, self.min_length]
+
+
+def to_single_precision(value):
+    return array.array('f', [value])[0]
+
+
+def load_summary_read_values(temp_out):
+    """
+    Returns a dictionary of read ID -> (length, mean qscore) from a batch's sequencing summary.
+    """
+    read_values = {}
+    for filename in temp_out.glob('**/sequencing_summary.txt'):
+        with open(str(filename), 'rt') as summary:
+            columns = summary.readline().rstrip('\n').split('\t')
+            try:
+                id_i = columns.index('read_id')
+                length_i = columns.index('sequence_length_template')
+                qscore_i = columns.index('mean_qscore_template')
+            except ValueError:
+                continue
+            for line in summary:
+                parts = line.rstrip('\n').split('\t')
+                try:
+                    read_values[parts[id_i]] = int(parts[length_i]), float(parts[qscore_i])
+                except (IndexError, ValueError):
+                    pass
+    return read_values
+
+
+def split_fastq(filename, read_filter, read_values):
+    """
+    Splits one of a batch's fastqs into the reads which pass the filter and those which fail,
+    judged by the read's length and qscore in the batch's summary (reads missing from the summary
+    pass). The two parts are written beside the fastq (as .pass and .fail files, which the
+    merge's *.fastq glob won't pick up if the merge is redone) and their filenames returned.
+    """
+    pass_filename = filename.with_name(filename.name + '.pass')
+    fail_filename = filename.with_name(filename.name + '.fail')
+    with open(str(filename), 'rb') as fastq, open(str(pass_filename), 'wb') as pass_file, \
+            open(str(fail_filename), 'wb') as fail_file:
+        for header in fastq:
+            record = header + next(fastq, b'') + next(fastq, b'') + next(fastq, b'')
+            values = read_values.get(get_fastq_read_id(header))
+            if values is None or read_filter.passes(*values):
+                pass_file.write(record)
+            else:
+                fail_file.write(record)
+    return pass_filename, fail_filename
 
 
 def merge_fastq(source_filename, destination_filename):
-    with open(str(source_filename), 'rt') as source:
-        with open(str(destination_filename), 'at') as destination:
-            for line in source:
-                destination.write(line)
+    if not destination_filename.endswith('.gz'):
+        return append_file(source_filename, destination_filename)
+    merged_bytes = 0
+    with open(str(source_filename), 'rb') as source:
+        with BgzfWriter(destination_filename) as destination:
+            for chunk in iter(lambda: source.read(MERGE_BUFFER_SIZE), b''):
+                destination.write(chunk)
+                merged_bytes += len(chunk)
+    return merged_bytes
 
 
 def merge_summary(source_filename, destination_filename):
+    """
+    Appends a batch's sequencing summary to the merged one. Only the first line is looked at: it
+    is the header, which is skipped unless the merged file is new.
+    """
     include_header = not destination_filename.is_file()
-    with open(str(source_filename), 'rt') as source:
-        with open(str(destination_filename), 'at') as destination:
-            for line in source:
-                if not include_header and line.startswith('filename'):
-                    continue
-                destination.write(line)
+    offset = 0
+    if not include_header:
+        with open(str(source_filename), 'rb') as source:
+            first_line = source.readline()
+        if first_line.startswith(b'filename'):
+            offset = len(first_line)
+    return append_file(source_filename, destination_filename, offset)
+
+
+def update_summary_columns(out_dir):
+    """
+    Brings the typed summary columns (see SummaryColumns) up to date with the merged
+    sequencing_summary.txt, by parsing only the lines added since the last update. Any column data
+    past the last recorded row (e.g. from a crash part way through an update) is dropped first.
+    """
+    summary_filename = out_dir / 'sequencing_summary.txt'
+    if not summary_filename.is_file():
+        return
+    directory = out_dir / SUMMARY_COLUMNS_DIR
+    directory.mkdir(exist_ok=True)
+    meta = load_summary_columns_meta(directory)
+    if summary_filename.stat().st_size < meta['summary_bytes']:
+        meta = load_summary_columns_meta(None)  # the summary has been replaced, so start again
+    with open(str(summary_filename), 'rb') as summary:
+        summary.seek(meta['summary_bytes'])
+        new_data = summary.read()
+    end = new_data.rfind(b'\n') + 1
+    lines = new_data[:end].decode().splitlines()
+    if meta['header'] is None:
+        if not lines:
+            return
+        meta['header'] = lines[0].strip().split('\t')
+        meta['columns'] = collections.OrderedDict((name, type_code)
+                                                  for name, type_code in SUMMARY_COLUMN_TYPES
+                                                  if name in meta['header'])
+        meta['categories'] = {name: [] for name in SUMMARY_CATEGORY_COLUMNS
+                              if name in meta['header']}
+    header = meta['header']
+    new_columns = {name: array.array(type_code) for name, type_code in meta['columns'].items()}
+    category_codes = {name: {v: i for i, v in enumerate(values)}
+                      for name, values in meta['categories'].items()}
+    column_numbers = [(header.index(name), name, new_columns[name]) for name in new_columns]
+    for line in lines:
+        if line.startswith('filename'):
+            continue
+        parts = line.strip().split('\t')
+        for i, name, values in column_numbers:
+            if name in category_codes:
+                values.append(get_index(parts[i], category_codes[name], meta['categories'][name]))
+            elif values.typecode in 'df':
+                values.append(float(parts[i]))
+            else:
+                values.append(int(parts[i]))
+    for name, values in new_columns.items():
+        with open_for_update(str(directory / name)) as column_file:
+            column_file.truncate(meta['rows'] * values.itemsize)
+            column_file.seek(0, os.SEEK_END)
+            values.tofile(column_file)
+    meta['rows'] += sum(1 for line in lines if not line.startswith('filename'))
+    meta['summary_bytes'] += end
+    temp_filename = str(directory / 'columns.json.tmp')
+    with open(temp_filename, 'wt') as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(temp_filename, str(directory / 'columns.json'))
+
+
+def load_summary_columns_meta(directory):
+    if directory is not None and (directory / 'columns.json').is_file():
+        with open(str(directory / 'columns.json'), 'rt') as meta_file:
+            return json.load(meta_file, object_pairs_hook=collections.OrderedDict)
+    return {'rows': 0, 'summary_bytes': 0, 'header': None, 'columns': {}, 'categories': {}}
+
+
+@contextlib.contextmanager
+def write_atomically(filename):
+    """
+    Opens a temporary file for writing text which replaces the given file when the with block
+    finishes, so anything reading the file (e.g. a script watching the output directory) sees
+    either the old version or the new one, never one which is partly written.
+    """
+    temp_filename = str(filename) + '.tmp'
+    try:
+        with open(temp_filename, 'wt') as temp_file:
+            yield temp_file
+        os.replace(temp_filename, str(filename))
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+def append_file(source_filename, destination_filename, offset=0):
+    """
+    Appends the source file (starting at the given offset) to the destination file and returns the
+    number of bytes appended. The copy is done by the kernel if possible, without the data passing
+    through Python, and otherwise with large buffered reads and writes.
+    """
+    with open(str(source_filename), 'rb') as source:
+        destination_fd = os.open(str(destination_filename), os.O_WRONLY | os.O_CREAT, 0o666)
+        with open(destination_fd, 'wb') as destination:
+            destination.seek(0, os.SEEK_END)
+            count = os.fstat(source.fileno()).st_size - offset
+            copied = kernel_copy(source.fileno(), destination.fileno(), offset, count)
+            if copied < count:
+                source.seek(offset + copied)
+                destination.seek(0, os.SEEK_END)
+                shutil.copyfileobj(source, destination, MERGE_BUFFER_SIZE)
+    return max(count, 0)
+
+
+def kernel_copy(source_fd, destination_fd, offset, count):
+    """
+    Copies count bytes from the source file (starting at offset) to the destination file's current
+    position using copy_file_range or sendfile. Returns how many bytes were copied, which will be
+    less than count if neither is supported here.
+    """
+    copied = 0
+    for copy_function in (copy_file_range, sendfile):
+        try:
+            while copied < count:
+                n = copy_function(source_fd, destination_fd, offset + copied, count - copied)
+                if n == 0:
+                    break
+                copied += n
+            return copied
+        except (OSError, AttributeError) as e:
+            if copied > 0 or getattr(e, 'errno', None) not in KERNEL_COPY_FALLBACK_ERRORS:
+                raise
+    return copied
+
+
+def copy_file_range(source_fd, destination_fd, offset, count):
+    return os.copy_file_range(source_fd, destination_fd, count, offset)
+
+
+def sendfile(source_fd, destination_fd, offset, count):
+    return os.sendfile(destination_fd, source_fd, offset, count)
+
+
+class BgzfWriter(object):
+    """
+    This class appends to a BGZF file: a gzip file made of independently compressed blocks of at
+    most 64 kB, which is what bgzip/htslib use. Blocks are compressed in a shared thread pool and
+    written in order. Alongside the file, it keeps a bgzip-compatible .gzi index (the compressed
+    and uncompressed offset of each block), so downstream tools can seek into the file or split
+    it up for parallel processing without decompressing it from the start.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.index_filename = filename + '.gzi'
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.pool = get_compression_pool()
+        self.compressed_offset, self.uncompressed_offset, self.index_count = \
+            find_bgzf_end(filename, self.index_filename)
+        self.file = open_for_update(filename)
+        self.file.seek(self.compressed_offset)
+        self.file.truncate()
+        self.index = open_for_update(self.index_filename)
+        self.index.seek(8 + 16 * self.index_count)
+        self.index.truncate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self.submit(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+
+    def submit(self, data):
+        self.pending.append(self.pool.submit(compress_bgzf_block, data))
+        while len(self.pending) > BGZF_MAX_PENDING_BLOCKS:
+            self.write_block(self.pending.popleft().result())
+
+    def write_block(self, block_and_size):
+        block, uncompressed_size = block_and_size
+        if self.compressed_offset > 0:  # the .gzi index doesn't include the first block
+            self.index.write(struct.pack('<QQ', self.compressed_offset, self.uncompressed_offset))
+            self.index_count += 1
+        self.file.write(block)
+        self.compressed_offset += len(block)
+        self.uncompressed_offset += uncompressed_size
+
+    def close(self):
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.write_block(self.pending.popleft().result())
+        self.file.write(BGZF_EOF)
+        self.file.close()
+        self.index.seek(0)
+        self.index.write(struct.pack('<Q', self.index_count))
+        self.index.close()
+
+
+def compress_bgzf_block(data):
+    compressor = zlib.compressobj(BGZF_COMPRESSION_LEVEL, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+                         len(compressed) + 25)
+    footer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+    return header + compressed + footer, len(data)
+
+
+def find_bgzf_end(filename, index_filename):
+    """
+    Returns the compressed and uncompressed offsets at which to append to an existing BGZF file
+    (i.e. before its EOF marker), along with the number of entries in its .gzi index. This only
+    needs to look at the last index entry and the last block, unless the file and index don't
+    agree (e.g. after a crash), in which case the index is rebuilt from the block headers.
+    """
+    if not os.path.isfile(filename):
+        return 0, 0, 0
+    file_size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        if file_size >= len(BGZF_EOF):
+            f.seek(file_size - len(BGZF_EOF))
+            if f.read() == BGZF_EOF:
+                file_size -= len(BGZF_EOF)
+        if file_size == 0:
+            return 0, 0, 0
+        try:
+            with open(index_filename, 'rb') as index:
+                index_count = struct.unpack('<Q', index.read(8))[0]
+                if index_count == 0:
+                    last_compressed, last_uncompressed = 0, 0
+                else:
+                    index.seek(8 + 16 * (index_count - 1))
+                    last_compressed, last_uncompressed = struct.unpack('<QQ', index.read(16))
+            block_size, uncompressed_size = read_bgzf_block_sizes(f, last_compressed)
+            if last_compressed + block_size == file_size:
+                return file_size, last_uncompressed + uncompressed_size, index_count
+        except (OSError, struct.error, ValueError):
+            pass
+    return rebuild_bgzf_index(filename, index_filename)
+
+
+def read_bgzf_block_sizes(f, offset):
+    """
+    Returns the compressed and uncompressed sizes of the BGZF block at the given offset.
+    """
+    f.seek(offset)
+    header = f.read(18)
+    if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04' or header[12:14] != b'BC':
+        raise ValueError('not a BGZF block')
+    block_size = struct.unpack('<H', header[16:18])[0] + 1
+    f.seek(offset + block_size - 4)
+    footer = f.read(4)
+    if len(footer) < 4:
+        raise ValueError('truncated BGZF block')
+    return block_size, struct.unpack('<I', footer)[0]
+
+
+def rebuild_bgzf_index(filename, index_filename):
+    """
+    Walks the block headers of a BGZF file to rebuild its .gzi index. Anything after the last
+    complete block (e.g. a partly written block) is dropped.
+    """
+    print('WARNING: rebuilding BGZF index for {}'.format(filename))
+    entries = []
+    compressed, uncompressed = 0, 0
+    with open(filename, 'rb') as f:
+        while True:
+            try:
+                block_size, uncompressed_size = read_bgzf_block_sizes(f, compressed)
+            except ValueError:
+                break
+            if uncompressed_size == 0:  # an EOF marker left by an earlier append
+                break
+            if compressed > 0:
+                entries.append((compressed, uncompressed))
+            compressed += block_size
+            uncompressed += uncompressed_size
+    with open(index_filename, 'wb') as index:
+        index.write(struct.pack('<Q', len(entries)))
+        for entry in entries:
+            index.write(struct.pack('<QQ', *entry))
+    return compressed, uncompressed, len(entries)
+
+
+class FastqReader(object):
+    """
+    Reads byte ranges (by uncompressed offset) from a plain or BGZF-compressed fastq. For BGZF,
+    the .gzi index gives the block to start from, so only the blocks which hold the range are
+    decompressed. The last block is kept, since nearby reads often share one.
+    """
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        self.compressed = filename.endswith('.gz')
+        self.block_offsets, self.block_starts = [0], [0]
+        self.block_start, self.block = None, b''
+        if self.compressed:
+            with open(filename + '.gzi', 'rb') as index:
+                count = struct.unpack('<Q', index.read(8))[0]
+                for _ in range(count):
+                    compressed, uncompressed = struct.unpack('<QQ', index.read(16))
+                    self.block_offsets.append(compressed)
+                    self.block_starts.append(uncompressed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+
+    def read(self, offset, length):
+        if not self.compressed:
+            self.file.seek(offset)
+            return self.file.read(length)
+        i = bisect.bisect_right(self.block_starts, offset) - 1
+        if self.block_start != self.block_starts[i]:
+            self.file.seek(self.block_offsets[i])
+            self.block_start, self.block = self.block_starts[i], self.read_block()
+        data = self.block[offset - self.block_start:]
+        while len(data) < length:
+            self.block_start += len(self.block)
+            self.block = self.read_block()
+            if not self.block:
+                break
+            data += self.block
+        return data[:length]
+
+    def read_block(self):
+        header = self.file.read(18)
+        if len(header) < 18:
+            return b''
+        block_size = struct.unpack('<H', header[16:18])[0] + 1
+        return zlib.decompress(self.file.read(block_size - 18)[:-8], -15)
+
+
+def open_for_update(filename):
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o666)
+    return open(fd, 'r+b')
+
+
+def get_compression_pool():
+    global COMPRESSION_POOL
+    if COMPRESSION_POOL is None:
+        COMPRESSION_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+    return COMPRESSION_POOL
 
 
 def get_timestamp(log_filename):
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+This script benchmarks basecall.py and fast_count on synthetic data, so versions can be compared
+without a sequencer or a GPU. It will
+* generate a run's worth of small fast5s (with MinKNOW-like run_id/exp_start_time attributes)
+* run each stage of basecall.py's main loop over them, using the fake guppy_basecaller in this
+  directory, and time every stage
+* generate big fastqs and time fast_count on them
+* write everything to a JSON report
+
+Generated data is kept in the work directory and reused by later runs with the same settings.
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+General Public License as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not,
+see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import collections
+import contextlib
+import datetime
+import json
+import os
+import pathlib
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import h5py
+import numpy as np
+
+BENCHMARK_DIR = pathlib.Path(__file__).resolve().parent
+REPO_DIR = BENCHMARK_DIR.parent
+sys.path.insert(0, str(REPO_DIR))
+import basecall  # noqa: E402
+
+
+# The stages of basecall.py's main loop, in the order they run for each batch.
+STAGES = ['discover', 'record_run_start', 'stage', 'basecall', 'merge', 'summary_update',
+          'summary_report']
+
+# Like MinKNOW, most fast5s go in fast5_pass and the rest in fast5_fail.
+FAIL_FRACTION = 0.1
+
+# Generated fast5s get an mtime this far in the past, so basecall.py sees them as finished.
+FAST5_AGE_SECONDS = 3600
+
+# Each synthetic run starts at this time.
+EXP_START_TIME = '2019-05-01T10:00:00Z'
+
+# Generated fastqs are written in blocks of about this size.
+FASTQ_BLOCK_SIZE = 64 * 1024 * 1024
+
+
+def main():
+    args = get_arguments()
+    args.work_dir.mkdir(parents=True, exist_ok=True)
+    report = collections.OrderedDict()
+    report['version'] = get_version()
+    report['date'] = datetime.datetime.now().isoformat()
+    report['machine'] = collections.OrderedDict([('platform', platform.platform()),
+                                                 ('python', platform.python_version()),
+                                                 ('cpus', os.cpu_count())])
+    report['settings'] = collections.OrderedDict(
+        (k, str(v) if isinstance(v, pathlib.Path) else v) for k, v in sorted(vars(args).items()))
+
+    report['basecall'] = []
+    for reads in args.reads:
+        fast5_dir = generate_run(args.work_dir, reads, args.reads_per_fast5, args.light_fast5s,
+                                 args.seed)
+        report['basecall'].append(benchmark_basecall(fast5_dir, reads, args))
+        write_report(report, args.report)
+
+    report['fast_count'] = []
+    if args.fastq_gb:
+        fast_count = build_fast_count()
+        for gigabytes in args.fastq_gb:
+            fastq = generate_fastq(args.work_dir, gigabytes, args.seed)
+            report['fast_count'].append(benchmark_fast_count(fast_count, fastq, args.threads))
+            write_report(report, args.report)
+
+    write_report(report, args.report)
+    log('Report written to {}'.format(args.report))
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark basecall.py and fast_count on '
+                                                 'synthetic data')
+    parser.add_argument('--reads', type=int, nargs='*', default=[10000, 1000000, 10000000],
+                        help='Run sizes (in reads) to benchmark basecall.py on')
+    parser.add_argument('--fastq_gb', type=float, nargs='*', default=[1.0, 4.0],
+                        help='Fastq sizes (in GB) to benchmark fast_count on')
+    parser.add_argument('--work_dir', type=pathlib.Path,
+                        default=pathlib.Path(tempfile.gettempdir()) / 'basecall_benchmark',
+                        help='Where generated data and outputs go (reused between runs)')
+    parser.add_argument('--report', type=pathlib.Path,
+                        help='JSON report filename (default: report.json in the work directory)')
+    parser.add_argument('--reads_per_fast5', type=int, default=4000,
+                        help='Reads in each fast5 (MinKNOW defaults to 4000)')
+    parser.add_argument('--batch_size', type=int, default=10,
+                        help='Fast5s per batch, as in basecall.py')
+    parser.add_argument('--barcodes', type=str, default='native_1-12',
+                        help='Barcodes to pass to basecall.py')
+    parser.add_argument('--compress', action='store_true',
+                        help='Benchmark basecall.py with --compress')
+    parser.add_argument('--reads_per_second', type=float, default=0.0,
+                        help='Basecalling speed of the fake Guppy (default: unlimited)')
+    parser.add_argument('--median_length', type=int, default=1000,
+                        help='Median read length from the fake Guppy (default: 1000, to keep '
+                             'output sizes manageable at 10M reads)')
+    parser.add_argument('--light_fast5s', action='store_true',
+                        help='Only write a full read group for the first read in each fast5 '
+                             '(much quicker to generate)')
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1,
+                        help='Threads for the multi-threaded fast_count runs')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for generated data')
+    args = parser.parse_args()
+    if args.report is None:
+        args.report = args.work_dir / 'report.json'
+    return args
+
+
+def benchmark_basecall(fast5_dir, reads, args):
+    """
+    Runs the same steps as basecall.py's main loop (in serial mode) over a generated run, timing
+    each stage. Guppy is the fake one in this directory, and the script's own output is hidden.
+    """
+    log('Benchmarking basecall.py on {:,} reads'.format(reads))
+    out_dir = args.work_dir / 'out_{}'.format(reads)
+    if out_dir.exists():
+        shutil.rmtree(str(out_dir))
+    os.environ['FAKE_GUPPY_READS_PER_SECOND'] = str(args.reads_per_second)
+    os.environ['FAKE_GUPPY_MEDIAN_LENGTH'] = str(args.median_length)
+    os.environ['PATH'] = str(BENCHMARK_DIR) + os.pathsep + os.environ.get('PATH', '')
+    command = 'guppy_basecaller'  # the fake one, now first on the PATH
+
+    timings = collections.OrderedDict((stage, 0.0) for stage in STAGES)
+    batch_count, start_time = 0, time.perf_counter()
+    with open(os.devnull, 'wt') as devnull, contextlib.redirect_stdout(devnull):
+        basecall.make_output_directory(out_dir)
+        ledger = basecall.Ledger(fast5_dir, out_dir)
+        ledger.recover()
+        basecall.update_summary_columns(out_dir)
+        summary = basecall.SummaryAggregator(out_dir)
+        run_start_times = basecall.RunStartTimes(out_dir)
+        discovery = basecall.Fast5Discovery(fast5_dir, ledger)
+        while True:
+            with timer(timings, 'discover'):
+                new_fast5s, all_fast5s = basecall.check_for_reads(discovery, args.batch_size)
+            if not new_fast5s:
+                break
+            with timer(timings, 'record_run_start'):
+                run_start_times.record(new_fast5s)
+            batch = basecall.Batch(new_fast5s, ledger)
+            try:
+                with timer(timings, 'stage'):
+                    batch.stage()
+                with timer(timings, 'basecall'):
+                    batch.basecall(command, args.barcodes, 'r9.4_hac', True)
+                with timer(timings, 'merge'):
+                    batch.merge(args.barcodes, args.compress)
+            finally:
+                batch.cleanup()
+            with timer(timings, 'summary_update'):
+                summary.update(run_start_times, all_fast5s)
+            with timer(timings, 'summary_report'):
+                basecall.summary_info(summary, out_dir, args.barcodes, 60)
+            batch_count += 1
+            if batch_count % 10 == 0:
+                log('  {:,} batches'.format(batch_count))
+    total_seconds = time.perf_counter() - start_time
+
+    result = collections.OrderedDict()
+    result['reads'] = reads
+    result['fast5s'] = len(discovery.all_fast5s())
+    result['batches'] = batch_count
+    result['basecalled_reads'] = summary.rows
+    result['output_bytes'] = sum(f.stat().st_size for f in out_dir.glob('*.fastq*'))
+    result['total_seconds'] = round(total_seconds, 3)
+    result['reads_per_second'] = round(reads / total_seconds, 1) if total_seconds > 0 else None
+    result['stage_seconds'] = collections.OrderedDict((stage, round(seconds, 3))
+                                                      for stage, seconds in timings.items())
+    result['stage_seconds_per_batch'] = collections.OrderedDict(
+        (stage, round(seconds / batch_count, 4) if batch_count else None)
+        for stage, seconds in timings.items())
+    log('  {:.1f} s total: {}'.format(total_seconds, ', '.join(
+        '{} {:.1f} s'.format(stage, seconds) for stage, seconds in timings.items())))
+    return result
+
+
+@contextlib.contextmanager
+def timer(timings, stage):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] += time.perf_counter() - start_time
+
+
+def generate_run(work_dir, reads, reads_per_fast5, light, seed):
+    """
+    Writes a synthetic run of multi-read fast5s (in fast5_pass and fast5_fail directories, like
+    MinKNOW) and returns its directory. An existing run with the same settings is reused.
+    """
+    run_dir = work_dir / 'run_{}_{}{}_{}'.format(reads, reads_per_fast5, '_light' if light else '',
+                                                 seed)
+    done_marker = run_dir / 'generated'
+    if done_marker.is_file():
+        return run_dir
+    if run_dir.exists():
+        shutil.rmtree(str(run_dir))
+    log('Generating {:,} reads of fast5s in {}'.format(reads, run_dir))
+
+    rng = random.Random('{}_{}'.format(seed, reads))
+    run_id = uuid.UUID(int=rng.getrandbits(128)).hex
+    flowcell = 'FAK{:05d}'.format(rng.randrange(100000))
+    old_time = time.time() - FAST5_AGE_SECONDS
+    sample_time, file_count = 0, (reads + reads_per_fast5 - 1) // reads_per_fast5
+    for i in range(file_count):
+        status = 'fail' if rng.random() < FAIL_FRACTION else 'pass'
+        directory = run_dir / 'fast5_{}'.format(status)
+        directory.mkdir(parents=True, exist_ok=True)
+        fast5 = directory / '{}_{}_{}_{}.fast5'.format(flowcell, status, run_id[:8], i)
+        count = min(reads_per_fast5, reads - i * reads_per_fast5)
+        sample_time = write_fast5(fast5, count, run_id, rng, sample_time, light)
+        os.utime(str(fast5), (old_time, old_time))
+        if (i + 1) % 100 == 0:
+            log('  {:,} / {:,} fast5s'.format(i + 1, file_count))
+    done_marker.write_text('{}\n'.format(reads))
+    return run_dir
+
+
+def write_fast5(fast5, count, run_id, rng, sample_time, light):
+    read_ids = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(count)]
+    channels = [rng.randint(1, 512) for _ in range(count)]
+    durations = [rng.randint(4000, 120000) for _ in range(count)]
+    start_times = []
+    for duration in durations:
+        sample_time += rng.randint(100, 2000)
+        start_times.append(sample_time)
+    attr = lambda s: np.bytes_(s.encode())
+
+    with h5py.File(str(fast5), 'w') as f:
+        f.attrs['file_version'] = attr('2.0')
+        for j in range(1 if light else count):
+            group = f.create_group('read_' + read_ids[j])
+            group.attrs['run_id'] = attr(run_id)
+            tracking_id = group.create_group('tracking_id')
+            tracking_id.attrs['run_id'] = attr(run_id)
+            tracking_id.attrs['exp_start_time'] = attr(EXP_START_TIME)
+            context_tags = group.create_group('context_tags')
+            context_tags.attrs['sequencing_kit'] = attr('sqk-lsk109')
+            channel_id = group.create_group('channel_id')
+            channel_id.attrs['channel_number'] = attr(str(channels[j]))
+            channel_id.attrs['sampling_rate'] = 4000.0
+            raw = group.create_group('Raw')
+            raw.attrs['read_id'] = attr(read_ids[j])
+            raw.attrs['start_time'] = np.uint64(start_times[j])
+            raw.attrs['duration'] = np.uint32(durations[j])
+            raw.create_dataset('Signal', data=np.zeros(16, dtype=np.int16))
+
+        # The fake Guppy reads this table instead of visiting every read group.
+        table = np.array(list(zip(read_ids, channels, start_times, durations)),
+                         dtype=[('read_id', 'S36'), ('channel', '<u2'), ('start_time', '<u8'),
+                                ('duration', '<u4')])
+        benchmark = f.create_group('Benchmark')
+        benchmark.attrs['run_id'] = attr(run_id)
+        benchmark.create_dataset('reads', data=table)
+    return sample_time
+
+
+def generate_fastq(work_dir, gigabytes, seed):
+    """
+    Writes a plain fastq of about the given size (a block of random reads repeated) and returns its
+    filename. An existing one is reused.
+    """
+    target_bytes = int(gigabytes * 1e9)
+    fastq = work_dir / 'reads_{}gb_{}.fastq'.format(gigabytes, seed)
+    if fastq.is_file() and fastq.stat().st_size >= target_bytes:
+        return fastq
+    log('Generating a {} GB fastq'.format(gigabytes))
+    rng = random.Random(seed)
+    bases = np.random.RandomState(seed).randint(0, 4, 1 << 20)
+    pool = np.frombuffer(b'ACGT', dtype=np.uint8)[bases].tobytes().decode()
+    records, size, read_number = [], 0, 0
+    while size < min(FASTQ_BLOCK_SIZE, target_bytes):
+        length = max(1, min(len(pool), int(rng.lognormvariate(8.85, 0.9))))
+        offset = rng.randrange(len(pool) - length + 1)
+        record = '@read_{}\n{}\n+\n{}\n'.format(read_number, pool[offset:offset + length],
+                                                chr(33 + rng.randint(5, 15)) * length)
+        records.append(record)
+        size += len(record)
+        read_number += 1
+    block = ''.join(records).encode()
+    with open(str(fastq), 'wb') as f:
+        written = 0
+        while written < target_bytes:
+            f.write(block)
+            written += len(block)
+    return fastq
+
+
+def build_fast_count():
+    fast_count = REPO_DIR / 'fast_count'
+    if not fast_count.is_file():
+        log('Building fast_count')
+        subprocess.check_call(['make', '-C', str(REPO_DIR)], stdout=subprocess.DEVNULL)
+    return fast_count
+
+
+def benchmark_fast_count(fast_count, fastq, threads):
+    """
+    Times fast_count on a fastq: single-threaded, multi-threaded and (for the incremental mode)
+    a first run plus a second run with nothing new to read.
+    """
+    log('Benchmarking fast_count on {}'.format(fastq.name))
+    size = fastq.stat().st_size
+    sidecar = pathlib.Path(str(fastq) + '.fast_count')
+    if sidecar.exists():
+        sidecar.unlink()
+    runs = collections.OrderedDict([('single_thread', []),
+                                    ('threads', ['--threads', str(threads)]),
+                                    ('incremental_first', ['--incremental']),
+                                    ('incremental_again', ['--incremental'])])
+    result = collections.OrderedDict([('fastq_bytes', size)])
+    for name, options in runs.items():
+        start_time = time.perf_counter()
+        output = subprocess.check_output([str(fast_count)] + options + [str(fastq)])
+        seconds = time.perf_counter() - start_time
+        result['reads'] = int(output.decode().split('\t')[1])
+        result[name] = collections.OrderedDict([
+            ('seconds', round(seconds, 3)),
+            ('megabytes_per_second', round(size / 1e6 / seconds, 1) if seconds > 0 else None)])
+        log('  {}: {:.2f} s'.format(name, seconds))
+    sidecar.unlink()
+    return result
+
+
+def get_version():
+    try:
+        return subprocess.check_output(['git', '-C', str(REPO_DIR), 'describe', '--always',
+                                        '--dirty'], stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+
+def write_report(report, filename):
+    temp_filename = filename.with_name(filename.name + '.tmp')
+    with open(str(temp_filename), 'wt') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
+    os.replace(str(temp_filename), str(filename))
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+if __name__ == '__main__':
+    main()
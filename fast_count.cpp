@@ -1,80 +1,548 @@
 #include <zlib.h>
 #include <stdio.h>
-#include "kseq.h"
+#include <stdlib.h>
+#include <string.h>
+#include <math.h>
+#include <stdint.h>
+#include <inttypes.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/stat.h>
 #include <vector>
-#include <functional>   // std::greater
+#include <map>
+#include <string>
+#include <deque>
+#include <thread>
+#include <mutex>
+#include <condition_variable>
+#include <atomic>
 #include <algorithm>
+#include "kseq.h"
 
-KSEQ_INIT(gzFile, gzread)
 
+// Read lengths below this are counted in a flat array, longer (rare) ones in a map.
+const int64_t FLAT_LENGTH_LIMIT = 1 << 20;
+
+// When decompressing in a separate thread, the decompressed data is handed over in chunks of this
+// size, and the decompressing thread can get this many chunks ahead.
+const int CHUNK_SIZE = 1 << 20;
+const size_t MAX_QUEUED_CHUNKS = 8;
+
+// In --incremental mode, each input file gets a sidecar file (its name plus this suffix) holding
+// how far it has been read and the stats so far. The sidecar also records a checksum of the bytes
+// just before that point, so a file which has been rewritten (not just appended to) is read from
+// the start again.
+const char *STATE_SUFFIX = ".fast_count";
+const int STATE_VERSION = 1;
+const int64_t STATE_CHECK_BYTES = 4096;
+
+// The empty block at the end of a BGZF file. basecall.py's BGZF writer replaces it when appending,
+// so reading can resume from where it starts.
+const unsigned char BGZF_EOF[28] = {0x1f, 0x8b, 0x08, 0x04, 0x00, 0x00, 0x00, 0x00, 0x00, 0xff,
+                                    0x06, 0x00, 0x42, 0x43, 0x02, 0x00, 0x1b, 0x00, 0x03, 0x00,
+                                    0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00};
 
-void print_header() {
-    printf("filename\tseq_count\ttotal_length\tn99_length\tn90_length\tn50_length\tn10_length\tn01_length\n");
-}
 
-void process_one_file(char* f) {
+// Chunks of decompressed data on their way from the decompressing thread to the parsing thread.
+struct ChunkQueue {
+    std::mutex mutex;
+    std::condition_variable changed;
+    std::deque<std::vector<char> > chunks;
+    bool finished = false;   // set by the decompressing thread at the end of the file
+    bool abandoned = false;  // set by the parsing thread when it doesn't need any more
+};
+
+// Where kseq gets its data: either straight from the (possibly gzipped) file or from a queue of
+// chunks decompressed by another thread.
+struct Source {
     gzFile fp;
-    kseq_t *seq;
-    int l;
-    fp = gzopen(f, "r");
-    seq = kseq_init(fp);
-    int seqCount = 0;
-    long long totalLen = 0;
-    std::vector<int> readLengths;
-    while ((l = kseq_read(seq)) >= 0) {
-        seqCount = seqCount + 1;
-        int readLen = int(strlen(seq->seq.s));
-        readLengths.push_back(readLen);
-        totalLen += readLen;
+    ChunkQueue *queue;
+    std::vector<char> chunk;
+    size_t pos;
+    int64_t remaining;  // how many more bytes to read from fp, or -1 for no limit
+};
+
+int source_read(Source *source, void *buf, int len) {
+    if (source->queue == NULL) {
+        if (source->remaining >= 0)
+            len = int(std::min(int64_t(len), source->remaining));
+        int n = (len > 0) ? gzread(source->fp, buf, len) : 0;
+        if (source->remaining >= 0 && n > 0)
+            source->remaining -= n;
+        return n;
     }
-    kseq_destroy(seq);
-    gzclose(fp);
+    if (source->pos == source->chunk.size()) {
+        ChunkQueue *queue = source->queue;
+        std::unique_lock<std::mutex> lock(queue->mutex);
+        queue->changed.wait(lock, [queue] { return !queue->chunks.empty() || queue->finished; });
+        if (queue->chunks.empty())
+            return 0;
+        source->chunk = std::move(queue->chunks.front());
+        source->pos = 0;
+        queue->chunks.pop_front();
+        queue->changed.notify_all();
+    }
+    size_t n = std::min(size_t(len), source->chunk.size() - source->pos);
+    memcpy(buf, source->chunk.data() + source->pos, n);
+    source->pos += n;
+    return int(n);
+}
+
+KSEQ_INIT(Source*, source_read)
 
-    // Find the N01, N10, N50, N90 and N99.
-    std::sort(readLengths.begin(), readLengths.end(), std::greater<long>());
-    long long target_01 = totalLen / 100;
-    long long target_10 = totalLen / 10;
-    long long target_50 = totalLen / 2;
-    long long target_90 = totalLen * 9 / 10;
-    long long target_99 = totalLen * 99 / 100;
-    long long lenSoFar = 0;
-    int n01 = 0, n10 = 0, n50 = 0, n90 = 0, n99 = 0;
-    bool set_01 = false, set_10 = false, set_50 = false, set_90 = false, set_99 = false;
-    for (int i = 0; i < seqCount; ++i) {
-        lenSoFar += readLengths[i];
-        if (lenSoFar >= target_01 && !set_01) {
-            n01 = readLengths[i];
-            set_01 = true;
+void decompress_chunks(gzFile fp, ChunkQueue *queue) {
+    while (true) {
+        std::vector<char> chunk(CHUNK_SIZE);
+        int n = gzread(fp, chunk.data(), CHUNK_SIZE);
+        std::unique_lock<std::mutex> lock(queue->mutex);
+        if (n <= 0) {
+            queue->finished = true;
+            queue->changed.notify_all();
+            return;
         }
-        if (lenSoFar >= target_10 && !set_10) {
-            n10 = readLengths[i];
-            set_10 = true;
+        chunk.resize(n);
+        queue->changed.wait(lock, [queue] {
+            return queue->chunks.size() < MAX_QUEUED_CHUNKS || queue->abandoned; });
+        if (queue->abandoned)
+            return;
+        queue->chunks.push_back(std::move(chunk));
+        queue->changed.notify_all();
+    }
+}
+
+
+// A histogram of read lengths, from which the Nx values can be found without sorting.
+struct LengthCounts {
+    std::vector<uint64_t> flat;
+    std::map<int64_t, uint64_t> longReads;
+
+    void add(int64_t length, uint64_t count) {
+        if (length < FLAT_LENGTH_LIMIT) {
+            if (length >= int64_t(flat.size()))
+                flat.resize(std::max(size_t(length + 1), flat.size() * 2));
+            flat[length] += count;
         }
-        if (lenSoFar >= target_50 && !set_50) {
-            n50 = readLengths[i];
-            set_50 = true;
+        else
+            longReads[length] += count;
+    }
+
+    void merge(const LengthCounts &other) {
+        for (size_t length = 0; length < other.flat.size(); ++length)
+            if (other.flat[length] > 0)
+                add(int64_t(length), other.flat[length]);
+        for (auto &lengthCount : other.longReads)
+            add(lengthCount.first, lengthCount.second);
+    }
+
+    // Calls f(length, count) for each length present, longest first.
+    template <typename F> void for_each_descending(F f) const {
+        for (auto it = longReads.rbegin(); it != longReads.rend(); ++it)
+            f(it->first, it->second);
+        for (size_t i = flat.size(); i > 0; --i)
+            if (flat[i - 1] > 0)
+                f(int64_t(i - 1), flat[i - 1]);
+    }
+};
+
+
+struct FileStats {
+    uint64_t seqCount = 0;
+    uint64_t totalLen = 0;
+    double qscoreSum = 0.0;
+    uint64_t qscoreCount = 0;
+    LengthCounts lengths;
+    bool fastq = false;
+    bool failed = false;
+};
+
+// What's saved in a sidecar file in --incremental mode.
+struct FileState {
+    uint64_t device = 0;
+    uint64_t inode = 0;
+    int64_t offset = 0;
+    uint32_t check = 0;
+    FileStats stats;
+};
+
+// Error probabilities for each phred+33 quality character, for read mean qscores.
+double errorProbs[256];
+
+void init_error_probs() {
+    for (int i = 0; i < 256; ++i)
+        errorProbs[i] = (i < 33) ? 1.0 : pow(10.0, -(i - 33) / 10.0);
+}
+
+// Like Guppy, a read's mean qscore is the qscore of its mean error probability.
+double read_mean_qscore(const kstring_t &qual) {
+    double errorSum = 0.0;
+    for (size_t i = 0; i < qual.l; ++i)
+        errorSum += errorProbs[(unsigned char)qual.s[i]];
+    return -10.0 * log10(errorSum / qual.l);
+}
+
+
+void print_header(bool extra) {
+    printf("filename\tseq_count\ttotal_length\tn99_length\tn90_length\tn50_length\tn10_length\tn01_length");
+    if (extra)
+        printf("\tmean_length\tmean_qscore\tlength_histogram");
+    printf("\n");
+}
+
+// Parses records into stats. In incremental mode it also checks whether the data ended part way
+// through a record (e.g. a file caught mid-append), returning false if so. A fastq record without
+// qualities is taken to be the start of one.
+bool parse_records(Source *source, FileStats &stats, bool qscores, bool incremental) {
+    kseq_t *seq = kseq_init(source);
+    int l;
+    bool complete = true;
+    while ((l = kseq_read(seq)) >= 0) {
+        if (incremental && stats.fastq && seq->qual.l == 0) {
+            complete = false;
+            break;
         }
-        if (lenSoFar >= target_90 && !set_90) {
-            n90 = readLengths[i];
-            set_90 = true;
+        stats.seqCount += 1;
+        int64_t readLen = int64_t(seq->seq.l);
+        stats.lengths.add(readLen, 1);
+        stats.totalLen += readLen;
+        if (seq->qual.l > 0)
+            stats.fastq = true;
+        if (qscores && seq->qual.l > 0) {
+            stats.qscoreSum += read_mean_qscore(seq->qual);
+            stats.qscoreCount += 1;
         }
-        if (lenSoFar >= target_99 && !set_99) {
-            n99 = readLengths[i];
-            set_99 = true;
+    }
+    if (l < -1)  // truncated qualities or a read error
+        complete = false;
+    kseq_destroy(seq);
+    return complete;
+}
+
+bool parse_stream(gzFile fp, FileStats &stats, bool separateDecompression, bool qscores,
+                  bool incremental, int64_t limit) {
+    gzbuffer(fp, CHUNK_SIZE);
+    ChunkQueue queue;
+    Source source;
+    source.fp = fp;
+    source.queue = separateDecompression ? &queue : NULL;
+    source.pos = 0;
+    source.remaining = limit;
+    std::thread decompressor;
+    if (separateDecompression)
+        decompressor = std::thread(decompress_chunks, fp, &queue);
+
+    bool complete = parse_records(&source, stats, qscores, incremental);
+
+    if (separateDecompression) {
+        // Parsing can stop before the end of the file (e.g. a truncated record), so make sure the
+        // decompressing thread isn't left waiting for space in the queue.
+        {
+            std::unique_lock<std::mutex> lock(queue.mutex);
+            queue.abandoned = true;
+            queue.changed.notify_all();
         }
-        if (set_01 && set_10 && set_50 && set_90 && set_99) {
-            break;
+        decompressor.join();
+    }
+    int gzError;
+    gzerror(fp, &gzError);
+    if (gzError != Z_OK && gzError != Z_STREAM_END)
+        complete = false;
+    return complete;
+}
+
+FileStats process_one_file(const char *f, bool separateDecompression, bool qscores) {
+    FileStats stats;
+    gzFile fp = gzopen(f, "r");
+    if (fp == NULL) {
+        fprintf(stderr, "Error: could not open %s\n", f);
+        stats.failed = true;
+        return stats;
+    }
+    parse_stream(fp, stats, separateDecompression, qscores, false, -1);
+    gzclose(fp);
+    return stats;
+}
+
+// Returns a checksum of the (up to) STATE_CHECK_BYTES bytes before the given offset.
+uint32_t get_check(int fd, int64_t offset) {
+    int64_t start = std::max(int64_t(0), offset - STATE_CHECK_BYTES);
+    std::vector<unsigned char> bytes(offset - start);
+    if (!bytes.empty() && pread(fd, bytes.data(), bytes.size(), start) != ssize_t(bytes.size()))
+        return 0;
+    return uint32_t(crc32(crc32(0L, Z_NULL, 0), bytes.data(), uInt(bytes.size())));
+}
+
+bool read_bytes(int fd, int64_t offset, unsigned char *bytes, size_t count) {
+    return offset >= 0 && pread(fd, bytes, count, offset) == ssize_t(count);
+}
+
+bool load_state(const std::string &filename, FileState &state) {
+    FILE *file = fopen(filename.c_str(), "r");
+    if (file == NULL)
+        return false;
+    int version = 0, fastq = 0;
+    long long offset;
+    unsigned long long device, inode, seqCount, totalLen, qscoreCount, distinctLengths;
+    unsigned int check;
+    bool ok = fscanf(file, "fast_count_state %d\n", &version) == 1 && version == STATE_VERSION &&
+              fscanf(file, "device %llu inode %llu offset %lld check %u\n",
+                     &device, &inode, &offset, &check) == 4 &&
+              fscanf(file, "seq_count %llu total_length %llu fastq %d\n",
+                     &seqCount, &totalLen, &fastq) == 3 &&
+              fscanf(file, "qscore_sum %lf qscore_count %llu\n",
+                     &state.stats.qscoreSum, &qscoreCount) == 2 &&
+              fscanf(file, "lengths %llu\n", &distinctLengths) == 1;
+    for (unsigned long long i = 0; ok && i < distinctLengths; ++i) {
+        long long length;
+        unsigned long long count;
+        ok = fscanf(file, "%lld %llu\n", &length, &count) == 2;
+        if (ok)
+            state.stats.lengths.add(length, count);
+    }
+    fclose(file);
+    state.device = device;
+    state.inode = inode;
+    state.offset = offset;
+    state.check = check;
+    state.stats.seqCount = seqCount;
+    state.stats.totalLen = totalLen;
+    state.stats.qscoreCount = qscoreCount;
+    state.stats.fastq = fastq != 0;
+    return ok;
+}
+
+void save_state(const std::string &filename, const FileState &state) {
+    std::string tempFilename = filename + ".tmp";
+    FILE *file = fopen(tempFilename.c_str(), "w");
+    if (file == NULL) {
+        fprintf(stderr, "Warning: could not write %s\n", filename.c_str());
+        return;
+    }
+    const FileStats &stats = state.stats;
+    unsigned long long distinctLengths = 0;
+    stats.lengths.for_each_descending([&](int64_t, uint64_t) { ++distinctLengths; });
+    fprintf(file, "fast_count_state %d\n", STATE_VERSION);
+    fprintf(file, "device %llu inode %llu offset %lld check %u\n",
+            (unsigned long long)state.device, (unsigned long long)state.inode,
+            (long long)state.offset, (unsigned int)state.check);
+    fprintf(file, "seq_count %llu total_length %llu fastq %d\n",
+            (unsigned long long)stats.seqCount, (unsigned long long)stats.totalLen,
+            stats.fastq ? 1 : 0);
+    fprintf(file, "qscore_sum %.17g qscore_count %llu\n", stats.qscoreSum,
+            (unsigned long long)stats.qscoreCount);
+    fprintf(file, "lengths %llu\n", distinctLengths);
+    stats.lengths.for_each_descending([&](int64_t length, uint64_t count) {
+        fprintf(file, "%lld %llu\n", (long long)length, (unsigned long long)count);
+    });
+    bool ok = fclose(file) == 0;
+    if (!ok || rename(tempFilename.c_str(), filename.c_str()) != 0) {
+        fprintf(stderr, "Warning: could not write %s\n", filename.c_str());
+        unlink(tempFilename.c_str());
+    }
+}
+
+// Like process_one_file, but resumes from the file's sidecar (if it still matches the file) and
+// writes an updated sidecar afterwards. Only plain files and BGZF files (e.g. from basecall.py
+// --compress) can be resumed: other gzipped files are read in full each time.
+FileStats process_one_file_incrementally(const char *f, bool separateDecompression) {
+    FileStats stats;
+    int fd = open(f, O_RDONLY);
+    struct stat st;
+    if (fd < 0 || fstat(fd, &st) != 0) {
+        fprintf(stderr, "Error: could not open %s\n", f);
+        stats.failed = true;
+        if (fd >= 0)
+            close(fd);
+        return stats;
+    }
+    unsigned char header[16];
+    bool gzipped = read_bytes(fd, 0, header, 2) && header[0] == 0x1f && header[1] == 0x8b;
+    bool bgzf = gzipped && read_bytes(fd, 0, header, 16) && (header[3] & 0x04) &&
+                header[12] == 'B' && header[13] == 'C';
+
+    std::string stateFilename = std::string(f) + STATE_SUFFIX;
+    FileState state;
+    int64_t offset = 0;
+    if ((!gzipped || bgzf) && load_state(stateFilename, state) &&
+            state.device == uint64_t(st.st_dev) && state.inode == uint64_t(st.st_ino) &&
+            state.offset <= int64_t(st.st_size) && state.check == get_check(fd, state.offset)) {
+        stats = state.stats;
+        offset = state.offset;
+    }
+
+    lseek(fd, offset, SEEK_SET);
+    int gzFd = dup(fd);  // shares fd's file position, which is needed afterwards
+    gzFile fp = gzdopen(gzFd, "r");
+    if (fp == NULL) {
+        fprintf(stderr, "Error: could not open %s\n", f);
+        stats.failed = true;
+        close(gzFd);
+        close(fd);
+        return stats;
+    }
+    int64_t limit = gzipped ? -1 : int64_t(st.st_size) - offset;
+    bool complete = parse_stream(fp, stats, separateDecompression && gzipped, true, true, limit);
+    int64_t end = gzipped ? int64_t(lseek(fd, 0, SEEK_CUR)) : int64_t(st.st_size);
+    gzclose(fp);
+
+    // Only save progress if the data ended cleanly, so anything caught part way through being
+    // appended is read again next time.
+    unsigned char tail[28];
+    if (complete && !gzipped && (end == 0 || (read_bytes(fd, end - 1, tail, 1) && tail[0] == '\n')))
+        state.offset = end;
+    else if (complete && bgzf && read_bytes(fd, end - 28, tail, 28) &&
+             memcmp(tail, BGZF_EOF, 28) == 0)
+        state.offset = end - 28;
+    else
+        complete = false;
+    if (complete) {
+        state.device = uint64_t(st.st_dev);
+        state.inode = uint64_t(st.st_ino);
+        state.check = get_check(fd, state.offset);
+        state.stats = stats;
+        save_state(stateFilename, state);
+    }
+    close(fd);
+    return stats;
+}
+
+// Finds the N01, N10, N50, N90 and N99 by walking the length histogram from the longest reads.
+void get_nx(const FileStats &stats, int64_t nx[5]) {
+    uint64_t totalLen = stats.totalLen;
+    uint64_t targets[5] = {totalLen * 99 / 100, totalLen * 9 / 10, totalLen / 2, totalLen / 10,
+                           totalLen / 100};
+    bool set[5] = {false, false, false, false, false};
+    for (int i = 0; i < 5; ++i)
+        nx[i] = 0;
+    uint64_t lenSoFar = 0;
+    stats.lengths.for_each_descending([&](int64_t length, uint64_t count) {
+        lenSoFar += uint64_t(length) * count;
+        for (int i = 0; i < 5; ++i) {
+            if (lenSoFar >= targets[i] && !set[i]) {
+                nx[i] = length;
+                set[i] = true;
+            }
         }
+    });
+}
+
+// The length histogram column uses 1-2-5 bins (0, 100, 200, 500, 1000, 2000, ...) and lists each
+// non-empty bin as lower_bound:count.
+std::string get_length_histogram(const FileStats &stats) {
+    std::vector<int64_t> binStarts;
+    binStarts.push_back(0);
+    for (int64_t scale = 100; scale < (int64_t(1) << 40); scale *= 10) {
+        binStarts.push_back(scale);
+        binStarts.push_back(scale * 2);
+        binStarts.push_back(scale * 5);
+    }
+    std::vector<uint64_t> binCounts(binStarts.size(), 0);
+    stats.lengths.for_each_descending([&](int64_t length, uint64_t count) {
+        size_t bin = std::upper_bound(binStarts.begin(), binStarts.end(), length) -
+                     binStarts.begin() - 1;
+        binCounts[bin] += count;
+    });
+    std::string histogram;
+    char buffer[64];
+    for (size_t i = 0; i < binCounts.size(); ++i) {
+        if (binCounts[i] == 0)
+            continue;
+        snprintf(buffer, sizeof(buffer), "%s%" PRId64 ":%" PRIu64, histogram.empty() ? "" : ",",
+                 binStarts[i], binCounts[i]);
+        histogram += buffer;
+    }
+    return histogram.empty() ? "-" : histogram;
+}
+
+void print_stats(const char *f, const FileStats &stats, bool extra) {
+    int64_t nx[5];
+    get_nx(stats, nx);
+    printf("%s\t%" PRIu64 "\t%" PRIu64 "\t%" PRId64 "\t%" PRId64 "\t%" PRId64 "\t%" PRId64
+           "\t%" PRId64, f, stats.seqCount, stats.totalLen, nx[0], nx[1], nx[2], nx[3], nx[4]);
+    if (extra) {
+        if (stats.seqCount > 0)
+            printf("\t%.1f", double(stats.totalLen) / stats.seqCount);
+        else
+            printf("\t-");
+        if (stats.qscoreCount > 0)
+            printf("\t%.2f", stats.qscoreSum / stats.qscoreCount);
+        else
+            printf("\t-");
+        printf("\t%s", get_length_histogram(stats).c_str());
     }
-    printf("%s\t%d\t%lld\t%d\t%d\t%d\t%d\t%d\n", f, seqCount, totalLen, n99, n90, n50, n10, n01);
+    printf("\n");
+}
+
+void print_usage() {
+    fprintf(stderr, "usage: fast_count [--threads N] [--extra] [--incremental] "
+                    "[fastq/fasta files...]\n");
 }
 
 int main(int argc, char *argv[]) {
-    if (argc == 1) {
-        print_header();
+    int threads = 1;
+    bool extra = false;
+    bool incremental = false;
+    std::vector<char*> files;
+    for (int i = 1; i < argc; ++i) {
+        if (strcmp(argv[i], "--threads") == 0 && i + 1 < argc) {
+            threads = atoi(argv[++i]);
+            if (threads < 1) {
+                print_usage();
+                return 1;
+            }
+        }
+        else if (strcmp(argv[i], "--extra") == 0)
+            extra = true;
+        else if (strcmp(argv[i], "--incremental") == 0)
+            incremental = true;
+        else if (strncmp(argv[i], "--", 2) == 0) {
+            print_usage();
+            return 1;
+        }
+        else
+            files.push_back(argv[i]);
+    }
+    if (files.empty()) {
+        print_header(extra);
         return 0;
     }
-    for (int i = 1; i < argc; ++i) {
-        process_one_file(argv[i]);
+    init_error_probs();
+
+    // Files are processed in parallel (one per thread), and any spare threads go to decompressing
+    // separately from parsing, which helps most for a single big gzipped file.
+    int workers = std::min(threads, int(files.size()));
+    bool separateDecompression = threads >= 2 * workers;
+    int exitCode = 0;
+    if (workers == 1) {
+        for (char *f : files) {
+            FileStats stats = incremental ? process_one_file_incrementally(f, separateDecompression)
+                                          : process_one_file(f, separateDecompression, extra);
+            if (stats.failed)
+                exitCode = 1;
+            else
+                print_stats(f, stats, extra);
+            fflush(stdout);
+        }
+        return exitCode;
+    }
+
+    std::vector<FileStats> results(files.size());
+    std::atomic<size_t> next(0);
+    std::vector<std::thread> pool;
+    for (int t = 0; t < workers; ++t) {
+        pool.push_back(std::thread([&]() {
+            for (size_t i = next++; i < files.size(); i = next++)
+                results[i] = incremental
+                           ? process_one_file_incrementally(files[i], separateDecompression)
+                           : process_one_file(files[i], separateDecompression, extra);
+        }));
+    }
+    for (std::thread &thread : pool)
+        thread.join();
+    for (size_t i = 0; i < files.size(); ++i) {
+        if (results[i].failed)
+            exitCode = 1;
+        else
+            print_stats(files[i], results[i], extra);
     }
+    return exitCode;
 }